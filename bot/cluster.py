@@ -0,0 +1,275 @@
+# bot/cluster.py
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bot.config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, SHUTDOWN_TIMEOUT,
+    WORKERS, WORKER_BASE_PORT, HEALTH_CHECK_INTERVAL
+)
+from bot.database import init_database
+from bot.main import SECRET_HEADER, create_bot, create_dispatcher, set_webhook
+
+# Points of every worker on the hash ring, more points spread users more evenly
+RING_REPLICAS = 100
+
+# How long the launcher waits for workers to start (in seconds)
+START_TIMEOUT = 60
+
+# Longest pause before a crashed worker is started again (in seconds)
+MAX_RESTART_DELAY = 30
+
+def ring_hash(value):
+    "Hash of the value, the same in every process (unlike hash() of a str)"
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of users to workers. A user always goes to the same
+    worker. While it is down its users go to the next workers on the ring and
+    come back when it is up again, users of other workers never move"""
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        points = sorted((ring_hash(f"{worker}:{replica}"), worker)
+                        for worker in workers for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.workers = [worker for _, worker in points]
+        self.count = len(set(self.workers))
+
+    def candidates(self, key):
+        "Workers in the order they should get the key"
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        seen = set()
+        for i in range(len(self.workers)):
+            worker = self.workers[(start + i) % len(self.workers)]
+            if worker not in seen:
+                seen.add(worker)
+                yield worker
+                if len(seen) == self.count:
+                    return
+
+
+def update_key(update):
+    "Id of the user (or chat) the update comes from, as the worker scheduler keys it"
+    for event in update.values():
+        if isinstance(event, dict):
+            user = event.get('from') or event.get('user')
+            if user:
+                return user['id']
+            chat = event.get('chat')
+            if chat:
+                return chat['id']
+    return update.get('update_id', 0)
+
+
+class Worker:
+    "Bot process in webhook mode listening on a local port"
+
+    def __init__(self, index):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self.healthy = False
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_at = None
+        self.stats = {}
+
+    async def start(self):
+        env = dict(os.environ, BOT_MODE='webhook', WEBHOOK_URL='', WEBHOOK_HOST='127.0.0.1',
+                   WEBHOOK_PORT=str(self.port), CLUSTER_WORKER='1')
+        # Own session: Ctrl+C in the terminal stops the launcher, which then stops workers
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bot.main", env=env, start_new_session=True)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        self.healthy = False
+        logging.info("Worker %d started on port %d (pid %d)", self.index, self.port, self.process.pid)
+
+    async def stop(self, timeout):
+        "Let the worker finish updates being processed, kill it after timeout"
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Worker %d did not stop in %.0f s, killing it", self.index, timeout)
+            self.process.kill()
+            await self.process.wait()
+
+
+class Cluster:
+    """Webhook receiver in front of worker processes: passes every update to the
+    worker of its user, checks workers and restarts the ones that crashed"""
+
+    def __init__(self, count):
+        self.workers = [Worker(index) for index in range(count)]
+        self.ring = HashRing(range(count))
+        self.session = None
+        self.health_task = None
+        self.stopping = False
+
+    def route(self, key):
+        "Healthy workers in the order they should get updates of the user"
+        for index in self.ring.candidates(key):
+            worker = self.workers[index]
+            if worker.healthy:
+                yield worker
+
+    def secret_headers(self):
+        return {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+
+    async def forward(self, request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+
+        body = await request.read()
+        try:
+            key = update_key(json.loads(body))
+        except (ValueError, AttributeError, TypeError):
+            return web.Response(status=400)
+
+        headers = {'Content-Type': 'application/json', **self.secret_headers()}
+        for worker in self.route(key):
+            try:
+                async with self.session.post(worker.url + WEBHOOK_PATH, data=body, headers=headers) as response:
+                    return web.Response(status=response.status, body=await response.read(),
+                                        content_type=response.content_type)
+            except aiohttp.ClientError:
+                logging.warning("Worker %d does not answer, passing its users on", worker.index)
+                worker.healthy = False
+
+        # No worker is up: Telegram sends the update again later
+        return web.Response(status=503)
+
+    async def health(self, request):
+        "State of the workers, 503 when none of them is up"
+        workers = [{'worker': worker.index, 'port': worker.port,
+                    'pid': worker.process.pid if worker.process else None,
+                    'healthy': worker.healthy, 'restarts': worker.restarts, **worker.stats}
+                   for worker in self.workers]
+        status = 200 if any(worker.healthy for worker in self.workers) else 503
+        return web.json_response({'workers': workers}, status=status)
+
+    async def check(self, worker):
+        "Health check of one worker, starts it again if it has exited"
+        if worker.process.returncode is not None:
+            worker.healthy = False
+            now = time.monotonic()
+            if worker.restart_at is None:
+                # Crash loops are slowed down, a worker that ran for a while restarts at once
+                if now - worker.started_at > 2 * MAX_RESTART_DELAY:
+                    worker.restarts = 0
+                delay = min(2 ** worker.restarts - 1, MAX_RESTART_DELAY)
+                worker.restarts += 1
+                worker.restart_at = now + delay
+                logging.warning("Worker %d exited with code %s, restarting in %d s",
+                                worker.index, worker.process.returncode, delay)
+            if now >= worker.restart_at and not self.stopping:
+                await worker.start()
+            return
+
+        try:
+            async with self.session.get(worker.url + '/health',
+                                        timeout=aiohttp.ClientTimeout(total=HEALTH_CHECK_INTERVAL)) as response:
+                healthy = response.status == 200
+                worker.stats = await response.json() if healthy else {}
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            healthy = False
+
+        if worker.healthy and not healthy:
+            logging.warning("Worker %d failed the health check", worker.index)
+        if healthy and not worker.healthy:
+            await self.recover(worker)
+        else:
+            worker.healthy = healthy
+
+    async def reset_caches(self, worker):
+        "Make the worker drop cached user data, True when it did"
+        try:
+            async with self.session.post(worker.url + '/reset-caches', headers=self.secret_headers(),
+                                         timeout=aiohttp.ClientTimeout(total=HEALTH_CHECK_INTERVAL)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def recover(self, worker):
+        """Let a worker that is up again get its users back. While it was down they
+        were served by other workers, so its cached data of them is stale, and so is
+        the data the other workers cached of them once they come back"""
+        if not await self.reset_caches(worker):
+            return
+        worker.healthy = True
+        if self.health_task:
+            logging.info("Worker %d is up again", worker.index)
+            await asyncio.gather(*(self.reset_caches(other) for other in self.workers
+                                   if other is not worker and other.healthy))
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(worker) for worker in self.workers))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            await self.check_all()
+
+    async def start(self, app):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        try:
+            for worker in self.workers:
+                await worker.start()
+
+            # Updates are accepted once every worker answers
+            deadline = time.monotonic() + START_TIMEOUT
+            while not all(worker.healthy for worker in self.workers) and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+                await asyncio.gather(*(self.check(worker) for worker in self.workers if not worker.healthy))
+        except BaseException:
+            # Stopped while starting: do not leave workers behind
+            await self.stop(app)
+            raise
+        logging.info("%d of %d workers are up", sum(worker.healthy for worker in self.workers), len(self.workers))
+        self.health_task = asyncio.create_task(self.watch())
+
+        if WEBHOOK_URL:
+            bot = create_bot()
+            try:
+                await set_webhook(bot, create_dispatcher())
+            finally:
+                await bot.session.close()
+
+    async def stop(self, app):
+        "Runs after the receiver has passed on all accepted updates"
+        self.stopping = True
+        if self.health_task:
+            self.health_task.cancel()
+        await asyncio.gather(*(worker.stop(SHUTDOWN_TIMEOUT + 5) for worker in self.workers))
+        await self.session.close()
+
+
+def main(count=WORKERS):
+    # Create missing tables once, before the workers open the database
+    init_database()
+
+    cluster = Cluster(count)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, cluster.forward)
+    app.router.add_get('/health', cluster.health)
+    app.on_startup.append(cluster.start)
+    app.on_cleanup.append(cluster.stop)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+
+if __name__ == "__main__":
+    # Several bot processes behind one webhook: python -m bot.cluster
+    main()
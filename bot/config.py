@@ -6,18 +6,108 @@ load_dotenv()
 # Telegram Bot Token
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'TOKEN')
 
+# Telegram Bot API server, empty for api.telegram.org (set for a local Bot API server)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+# How updates are received: 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Public base URL of the webhook (e.g. https://example.com). When empty the
+# webhook is not registered at startup and has to be set up separately
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+
+# Path of the webhook endpoint and the secret Telegram sends with every update
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Address the webhook server listens on
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+
+# Answer Telegram at once and process updates in the background (0 keeps the
+# request open until the update is processed, used for load tests)
+WEBHOOK_IN_BACKGROUND = os.getenv('WEBHOOK_IN_BACKGROUND', '1') != '0'
+
+# How long shutdown waits for updates being processed (in seconds)
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 30))
+
+# python -m bot.cluster: number of bot processes behind the webhook
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+
+# Local port of the first worker, the others use the following ports
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', 8100))
+
+# Set by bot.cluster for the processes it starts. Only such a process bound to
+# 127.0.0.1 serves /health and /reset-caches, they are not meant for the outside
+CLUSTER_WORKER = os.getenv('CLUSTER_WORKER', '0') == '1'
+
+# How often the launcher checks that workers answer (in seconds)
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 5))
+
+# Updates of different users processed at the same time. Updates of one user
+# are always processed one after another, in the order they came
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 32))
+
+# Updates accepted for processing (queued or being processed). Further updates
+# wait until there is room, and polling stops fetching new ones
+SCHEDULER_MAX_PENDING = int(os.getenv('SCHEDULER_MAX_PENDING', 1000))
+
+# How often scheduler queue and DeepSeek metrics are logged (in seconds, 0 to turn off)
+SCHEDULER_STATS_INTERVAL = float(os.getenv('SCHEDULER_STATS_INTERVAL', 60))
+
+# Where dialog states (FSM) are kept: 'sqlite' in the bot database, shared by
+# all bot processes and kept over restarts, or 'memory' of this process
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+
+# Dialog states not changed for this long are dropped (in seconds)
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 30 * 24 * 3600))
+
 # DeepSeek API Key
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY', 'TOKEN')
 
+# DeepSeek API endpoint (OpenAI compatible)
+DEEPSEEK_BASE_URL = os.getenv('DEEPSEEK_BASE_URL', 'https://openrouter.ai/api/v1')
+
+# DeepSeek request timeout (in seconds)
+DEEPSEEK_TIMEOUT = float(os.getenv('DEEPSEEK_TIMEOUT', 60))
+
+# Maximum number of simultaneous DeepSeek requests
+DEEPSEEK_MAX_CONCURRENCY = int(os.getenv('DEEPSEEK_MAX_CONCURRENCY', 8))
+
+# Retries for rate limited (429) and failed (5xx) DeepSeek requests
+DEEPSEEK_MAX_RETRIES = int(os.getenv('DEEPSEEK_MAX_RETRIES', 3))
+
 # Database path
-DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'users.db')
+DATABASE_PATH = os.getenv('DATABASE_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'users.db'))
 
 # Encryption key
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY', b'your-32-byte-encryption-key-here!!')
 
+# Previous encryption keys, comma separated. Data encrypted with them can still be
+# read until python -m bot.rotate_keys re-encrypts it with ENCRYPTION_KEY
+OLD_ENCRYPTION_KEYS = [key for key in os.getenv('OLD_ENCRYPTION_KEYS', '').split(',') if key]
+
+# How long generated routes are kept in the route cache (in seconds)
+ROUTE_CACHE_TTL = int(os.getenv('ROUTE_CACHE_TTL', 7 * 24 * 3600))
+
+# Number of routes kept in memory in front of the route cache table
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', 1000))
+
+# Number of interest inputs kept in memory for interest suggestions lookup
+INTERESTS_CACHE_SIZE = int(os.getenv('INTERESTS_CACHE_SIZE', 5000))
+
+# Number of recently active users whose data is kept in memory
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+
 # Points per visited object
 POINTS_PER_OBJECT = 10
 
+# Live location updates from one user closer in time than this are skipped (in seconds)
+LIVE_LOCATION_MIN_INTERVAL = float(os.getenv('LIVE_LOCATION_MIN_INTERVAL', 3))
+
+# Live location sessions without updates for this long are dropped (in seconds)
+LIVE_LOCATION_SESSION_TTL = int(os.getenv('LIVE_LOCATION_SESSION_TTL', 3600))
+
 # Accuracy for location matching (in meters)
 
 LOCATION_ACCURACY = 50
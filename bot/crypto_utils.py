@@ -1,15 +1,39 @@
-from cryptography.fernet import Fernet
-from bot.config import ENCRYPTION_KEY
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from concurrent.futures import ProcessPoolExecutor
+from bot.config import ENCRYPTION_KEY, OLD_ENCRYPTION_KEYS
 import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
 
-# Ensure the key is 32 bytes
-if len(ENCRYPTION_KEY) != 32:
-    # Pad or truncate to 32 bytes
-    key_bytes = ENCRYPTION_KEY.encode() if isinstance(ENCRYPTION_KEY, str) else ENCRYPTION_KEY
-    key_bytes = (key_bytes * (32 // len(key_bytes) + 1))[:32]
-    CIPHER_SUITE = Fernet(base64.urlsafe_b64encode(key_bytes))
-else:
-    CIPHER_SUITE = Fernet(base64.urlsafe_b64encode(ENCRYPTION_KEY))
+def make_cipher(key):
+    "Create Fernet cipher from an encryption key of any length"
+    key_bytes = key.encode() if isinstance(key, str) else key
+    # Ensure the key is 32 bytes
+    if len(key_bytes) != 32:
+        # Pad or truncate to 32 bytes
+        key_bytes = (key_bytes * (32 // len(key_bytes) + 1))[:32]
+    return Fernet(base64.urlsafe_b64encode(key_bytes))
+
+
+def make_blind_index_key(key):
+    "Derive blind index key from an encryption key"
+    key_bytes = key.encode() if isinstance(key, str) else key
+    return hmac.new(key_bytes, b"blind-index", hashlib.sha256).digest()
+
+
+# New data is encrypted with the current key, old keys are only used for reading
+ENCRYPTION_KEYS = [ENCRYPTION_KEY] + OLD_ENCRYPTION_KEYS
+CIPHER_SUITE = MultiFernet([make_cipher(key) for key in ENCRYPTION_KEYS])
+
+# Blind indexes use their own keys derived from the encryption keys
+BLIND_INDEX_KEYS = [make_blind_index_key(key) for key in ENCRYPTION_KEYS]
+BLIND_INDEX_KEY = BLIND_INDEX_KEYS[0]
+
+# Identifies the current key without revealing it
+KEY_FINGERPRINT = hashlib.sha256(BLIND_INDEX_KEY).hexdigest()[:16]
 
 def encrypt_data(data: str) -> str:
     "Encrypt string data"
@@ -24,4 +48,92 @@ def decrypt_data(token: str) -> str:
     try:
         return CIPHER_SUITE.decrypt(token.encode()).decode()
     except:
-        return token  # Return as is if decryption fails
\ No newline at end of file
+        return token  # Return as is if decryption fails
+
+def phone_blind_index(phone: str, key=BLIND_INDEX_KEY) -> str:
+    "Keyed hash of the phone number, equal for equal numbers, to search encrypted phones"
+    digits = re.sub(r"\D", "", phone or "")
+    if not digits:
+        return None
+    return hmac.new(key, digits.encode(), hashlib.sha256).hexdigest()
+
+
+def phone_blind_indexes(phone: str):
+    "Blind indexes of the phone number for the current and all old keys"
+    return [phone_blind_index(phone, key) for key in BLIND_INDEX_KEYS]
+
+
+def looks_like_token(value: str) -> bool:
+    "Check if the value has the format of a Fernet token (whatever key it was made with)"
+    try:
+        raw = base64.urlsafe_b64decode(value.encode())
+    except ValueError:
+        return False
+    # Version byte, timestamp, IV, AES blocks and HMAC
+    return len(raw) >= 57 and raw[0] == 0x80 and (len(raw) - 57) % 16 == 0
+
+
+def rotate_data(token: str) -> str:
+    """Re-encrypt token with the current key. Raises ValueError for a token made
+    with a key that is neither ENCRYPTION_KEY nor in OLD_ENCRYPTION_KEYS"""
+    if not token:
+        return token
+    try:
+        return CIPHER_SUITE.rotate(token.encode()).decode()
+    except InvalidToken:
+        if looks_like_token(token):
+            raise ValueError("Data is encrypted with an unknown key, add it to OLD_ENCRYPTION_KEYS")
+        # Value stored without encryption (decrypt_data shows such values as is)
+        return encrypt_data(token)
+
+
+def rotate_users_chunk(rows):
+    """Re-encrypt (id, name, phone) rows with the current key (runs in a worker process
+    during key rotation). Returns (id, old name, old phone, new name, new phone, phone index)"""
+    return [(user_id, name, phone, rotate_data(name), rotate_data(phone),
+             phone_blind_index(decrypt_data(phone)))
+            for user_id, name, phone in rows]
+
+
+def decrypt_chunk(tokens):
+    "Decrypt a list of tokens (runs in a worker process during bulk decryption)"
+    return [decrypt_data(token) for token in tokens]
+
+
+def decrypt_bulk(tokens, chunk_size=10000, workers=None):
+    """Decrypt many tokens, yielding lists of decrypted chunk_size tokens in order
+    as soon as each is ready. Several chunks are decrypted in parallel in a process pool"""
+    chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+
+    if len(chunks) < 2 or workers < 2:
+        for chunk in chunks:
+            yield decrypt_chunk(chunk)
+        return
+
+    # Callers may have other threads (the admin panel does), a forked child could
+    # inherit a lock one of them holds and hang, so workers are started fresh
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        yield from pool.map(decrypt_chunk, chunks)
+
+
+if __name__ == "__main__":
+    # Benchmark: python -m bot.crypto_utils
+    import time
+
+    users = 100000
+    tokens = [encrypt_data(value) for i in range(users) for value in (f"Пользователь {i}", f"+37529{i:07d}")]
+
+    started = time.perf_counter()
+    decrypt_chunk(tokens)
+    serial = time.perf_counter() - started
+    print(f"serial: {serial:.2f} s for {users} users")
+
+    started = time.perf_counter()
+    first_chunk = None
+    for chunk in decrypt_bulk(tokens):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - started
+    parallel = time.perf_counter() - started
+    print(f"bulk ({os.cpu_count()} processes): {parallel:.2f} s, first chunk after {first_chunk:.2f} s, "
+          f"speedup {serial / parallel:.1f}x")
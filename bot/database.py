@@ -1,12 +1,145 @@
+import asyncio
+import functools
 import sqlite3
 import json
-from bot.config import DATABASE_PATH
-from bot.crypto_utils import encrypt_data, decrypt_data
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bot.config import DATABASE_PATH, USER_CACHE_SIZE
+from bot.crypto_utils import encrypt_data, decrypt_data, decrypt_bulk, phone_blind_index, phone_blind_indexes
+
+# One connection per thread, reused between calls instead of reconnecting every time
+_local = threading.local()
+
+# The bot runs all database work on a single dedicated thread, so a slow commit
+# never blocks the event loop and writes from different chats never contend
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+
+def get_connection():
+    "Get the database connection of the current thread"
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        _local.conn = conn
+    return conn
+
+
+def close_connection():
+    "Close the database connection of the current thread, the next call opens a new one"
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def call_db(func, *args, **kwargs):
+    """Run a database function. If it fails, whatever it left uncommitted is rolled
+    back, so the next call on the reused connection does not commit half a write"""
+    try:
+        return func(*args, **kwargs)
+    except BaseException:
+        conn = getattr(_local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        raise
+
+
+async def run_db(func, *args, **kwargs):
+    "Run a database function on the database thread and await its result"
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(call_db, func, *args, **kwargs))
+
+
+# Week of the weekly leaderboard (weeks start on Monday) as an SQL expression
+CURRENT_WEEK = "strftime('%Y-%W', 'now', 'localtime')"
+
+# Columns of the users table a UserRecord can hold
+USER_COLUMNS = ('id', 'tg_id', 'name', 'phone', 'points', 'interests', 'route_step', 'current_route_id', 'created_at')
+
+
+class UserRecord:
+    "User row with only the fetched columns. Name and phone are decrypted on first access"
+    __slots__ = ('id', 'tg_id', 'points', 'interests', 'route_step', 'current_route_id', 'created_at',
+                 'name_token', 'phone_token', '_name', '_phone')
+
+    def __init__(self, columns, row):
+        for column, value in zip(columns, row):
+            if column == 'name':
+                self.name_token = value
+            elif column == 'phone':
+                self.phone_token = value
+            else:
+                setattr(self, column, value)
+
+    @property
+    def name(self):
+        try:
+            return self._name
+        except AttributeError:
+            self._name = decrypt_data(self.name_token)
+            return self._name
+
+    @property
+    def phone(self):
+        try:
+            return self._phone
+        except AttributeError:
+            self._phone = decrypt_data(self.phone_token)
+            return self._phone
+
+
+# Decoded data of recently active users: tg_id -> {"user": ..., "route_state": ..., ...}.
+# Every function changing a user row drops the user's entry, so the cache stays
+# coherent as long as the user is only written through this process. bot.cluster
+# clears it when users have been served by another process meanwhile
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+
+
+def cached_user_data(tg_id, key, load):
+    "Get user data from the user cache, loading it with load() on a miss"
+    with user_cache_lock:
+        entry = user_cache.get(tg_id)
+        if entry is not None and key in entry:
+            user_cache.move_to_end(tg_id)
+            return entry[key]
+
+    value = load()
+    if value is None:
+        # Unknown users are not cached
+        return None
+
+    with user_cache_lock:
+        user_cache.setdefault(tg_id, {})[key] = value
+        user_cache.move_to_end(tg_id)
+        while len(user_cache) > USER_CACHE_SIZE:
+            user_cache.popitem(last=False)
+
+    return value
+
+
+def invalidate_user(tg_id):
+    "Drop cached data of the user after it was changed"
+    with user_cache_lock:
+        user_cache.pop(tg_id, None)
+
+
+def clear_user_cache():
+    "Drop cached data of all users"
+    with user_cache_lock:
+        user_cache.clear()
 
 
 def init_database():
     "Initialize the database with required tables"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Create users table
@@ -38,234 +171,1065 @@ def init_database():
         )
     ''')
 
+    # Create metadata table (versions of cached data shared between processes)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO metadata (key, value) VALUES ('shop_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS shop_items_version_{event.lower()} AFTER {event} ON shop_items BEGIN
+                UPDATE metadata SET value = value + 1 WHERE key = 'shop_version';
+            END
+        ''')
+
+    # Create purchases table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            name TEXT,
+            price INTEGER NOT NULL,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_tg_id ON purchases (tg_id)")
+
+    # Create routes tables
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS routes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_routes_tg_id ON routes (tg_id)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS route_stops (
+            route_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            PRIMARY KEY (route_id, position)
+        )
+    ''')
+
+    # Create visits table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            route_id INTEGER,
+            name TEXT,
+            description TEXT,
+            latitude REAL,
+            longitude REAL,
+            visited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_visits_tg_id ON visits (tg_id)")
+
+    # Create route cache table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS route_cache (
+            interests_key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            route TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (interests_key, count)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_route_cache_created_at ON route_cache (created_at)")
+
+    # Create interests suggestions cache table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS interests_cache (
+            input_key TEXT PRIMARY KEY,
+            suggestions TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Create dialog states table (bot.fsm_storage). Rows are keyed by bot, chat and
+    # user, data is compact JSON encrypted like other personal data
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)")
+
+    # Create key rotation progress table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS key_rotation (
+            key_fingerprint TEXT PRIMARY KEY,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            rotated_users INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Create points of interest catalog tables
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pois (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            tags TEXT,
+            cell_lat INTEGER NOT NULL,
+            cell_lon INTEGER NOT NULL,
+            UNIQUE (name, latitude, longitude)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pois_cell ON pois (cell_lat, cell_lon)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS poi_tags (
+            tag TEXT NOT NULL,
+            poi_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, poi_id)
+        )
+    ''')
+
+    # Columns added to tables after they were first created
+    add_missing_column(cursor, 'users', 'current_route_id', 'INTEGER')
+    add_missing_column(cursor, 'routes', 'free_order', 'INTEGER DEFAULT 0')
+    if add_missing_column(cursor, 'route_stops', 'visited', 'INTEGER DEFAULT 0'):
+        # Objects of started routes before the current step were already visited
+        mark_passed_stops(cursor)
+    add_missing_column(cursor, 'users', 'phone_index', 'TEXT')
+    add_missing_column(cursor, 'shop_items', 'stock', 'INTEGER')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_phone_index ON users (phone_index)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_points ON users (points)")
+
+    # Full text search over user interests and shop items for the admin panel
+    create_fts_index(cursor, 'users', ('interests',))
+    create_fts_index(cursor, 'shop_items', ('name', 'description', 'category'))
+
+    create_leaderboard_tables(cursor)
+    drop_stop_word_keys(cursor)
+
+    migrate_json_routes(cursor)
+    backfill_phone_index(cursor)
+
     conn.commit()
-    conn.close()
+
+    clear_user_cache()
+
+
+def add_missing_column(cursor, table, column, definition):
+    "Add column to a table created by an older version of the bot, returns True if it was added"
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [info[1] for info in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    return False
+
+
+def create_fts_index(cursor, table, columns):
+    """Create FTS5 full text index {table}_fts over the columns of the table,
+    kept in sync with it by triggers. Existing rows are indexed when it is created"""
+    fts = f"{table}_fts"
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+    if cursor.fetchone():
+        return
+
+    names = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE {fts} USING fts5(
+            {names}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    # Only changes of the indexed columns touch the index (not every points update)
+    cursor.execute(f'''
+        CREATE TRIGGER {fts}_update AFTER UPDATE OF {names} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new_values});
+        END
+    ''')
+    cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def count_sql(board, points, delta):
+    "Statements changing the number of users with the points on the leaderboard by delta (trigger body)"
+    if delta > 0:
+        return f'''
+            INSERT INTO points_counts (board, points, users) VALUES ({board}, {points}, 1)
+            ON CONFLICT (board, points) DO UPDATE SET users = users + 1;
+        '''
+    return f'''
+        UPDATE points_counts SET users = users - 1 WHERE board = {board} AND points = {points};
+        DELETE FROM points_counts WHERE board = {board} AND points = {points} AND users = 0;
+    '''
+
+
+def create_leaderboard_tables(cursor):
+    """Create leaderboard tables: points earned per week, points of users per
+    interest and the number of users per points value of every leaderboard.
+    Triggers keep them up to date in the same transaction as every points change"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'points_counts'")
+    created = cursor.fetchone() is None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_points (
+            week TEXT NOT NULL,
+            tg_id INTEGER NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (week, tg_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_weekly_points ON weekly_points (week, points)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS interest_points (
+            interest TEXT NOT NULL,
+            tg_id INTEGER NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (interest, tg_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interest_points ON interest_points (interest, points)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_interest_points_tg_id ON interest_points (tg_id)")
+
+    # Rank of a user is 1 + number of users with more points, summed from here
+    # over distinct points values instead of counting users
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS points_counts (
+            board TEXT NOT NULL,
+            points INTEGER NOT NULL,
+            users INTEGER NOT NULL,
+            PRIMARY KEY (board, points)
+        )
+    ''')
+
+    boards = {
+        'users': "'all'",
+        'weekly_points': "'week:' || {row}.week",
+        'interest_points': "'interest:' || {row}.interest",
+    }
+    for table, board in boards.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_counts_insert AFTER INSERT ON {table} BEGIN
+                {count_sql(board.format(row='new'), 'new.points', 1)}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_counts_delete AFTER DELETE ON {table} BEGIN
+                {count_sql(board.format(row='old'), 'old.points', -1)}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_counts_update AFTER UPDATE OF points ON {table}
+            WHEN new.points != old.points BEGIN
+                {count_sql(board.format(row='old'), 'old.points', -1)}
+                {count_sql(board.format(row='new'), 'new.points', 1)}
+            END
+        ''')
+
+    # Points changes of a user reach the interest and weekly leaderboards
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_points_leaderboards AFTER UPDATE OF points ON users
+        WHEN new.points != old.points BEGIN
+            UPDATE interest_points SET points = new.points WHERE tg_id = new.tg_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_points_weekly AFTER UPDATE OF points ON users
+        WHEN new.points > old.points BEGIN
+            INSERT INTO weekly_points (week, tg_id, points)
+            VALUES ({CURRENT_WEEK}, new.tg_id, new.points - old.points)
+            ON CONFLICT (week, tg_id) DO UPDATE SET points = points + excluded.points;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_delete_leaderboards AFTER DELETE ON users BEGIN
+            DELETE FROM interest_points WHERE tg_id = old.tg_id;
+            DELETE FROM weekly_points WHERE tg_id = old.tg_id;
+        END
+    ''')
+
+    if created:
+        # Leaderboards of users registered before they existed
+        cursor.execute("INSERT INTO points_counts (board, points, users) "
+                       "SELECT 'all', points, COUNT(*) FROM users GROUP BY points")
+        cursor.execute("SELECT tg_id, interests, points FROM users WHERE interests IS NOT NULL AND interests != ''")
+        cursor.executemany("INSERT OR IGNORE INTO interest_points (interest, tg_id, points) VALUES (?, ?, ?)",
+                           [(key, tg_id, points) for tg_id, interests, points in cursor.fetchall()
+                            for key in interest_keys(interests)])
+
+    # Weekly points are only shown for the current week
+    cursor.execute("DELETE FROM weekly_points WHERE week < strftime('%Y-%W', 'now', 'localtime', '-28 days')")
+
+
+def interest_keys(interests):
+    "Word stems of the interests, the interest leaderboards are kept by them"
+    # Imported here because interests_cache imports this module
+    from bot.interests_cache import interest_words
+    return [word_stem for word_stem, word in interest_words(interests)]
+
+
+def drop_stop_word_keys(cursor):
+    "Delete interest leaderboard rows and catalog tags made from one-letter or stop words"
+    from bot.interests_cache import STOP_WORDS, stem
+    stop_stems = sorted({stem(word) for word in STOP_WORDS})
+    placeholders = ", ".join("?" * len(stop_stems))
+    cursor.execute(f"DELETE FROM interest_points WHERE length(interest) < 2 OR interest IN ({placeholders})",
+                   stop_stems)
+    cursor.execute(f"DELETE FROM poi_tags WHERE length(tag) < 2 OR tag IN ({placeholders})", stop_stems)
+
+
+def fts_query(text):
+    "FTS5 query matching rows with words starting with every word of the text"
+    words = re.findall(r"\w+", (text or "").lower())
+    return " ".join(f'"{word}"*' for word in words) or None
+
+
+def migrate_json_routes(cursor):
+    """Move routes and visited objects stored as JSON in the users row into the
+    routes, route_stops and visits tables. Migrated JSON columns are cleared, so
+    running it again does nothing"""
+    cursor.execute('''
+        SELECT tg_id, current_route, visited_objects FROM users
+        WHERE (current_route IS NOT NULL AND current_route != '')
+           OR (visited_objects IS NOT NULL AND visited_objects NOT IN ('', '[]'))
+    ''')
+    rows = cursor.fetchall()
+
+    for tg_id, route_json, visited_json in rows:
+        try:
+            route = json.loads(route_json) if route_json else []
+        except:
+            route = []
+
+        try:
+            visited = json.loads(visited_json) if visited_json else []
+        except:
+            visited = []
+
+        if route:
+            route_id = insert_route(cursor, tg_id, route)
+            cursor.execute("UPDATE users SET current_route_id = ? WHERE tg_id = ?", (route_id, tg_id))
+
+        cursor.executemany('''
+            INSERT INTO visits (tg_id, name, description, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(tg_id, obj.get('name'), obj.get('description'), obj.get('latitude'), obj.get('longitude'))
+              for obj in visited])
+
+        cursor.execute("UPDATE users SET current_route = NULL, visited_objects = NULL WHERE tg_id = ?",
+                       (tg_id,))
+
+
+def backfill_phone_index(cursor, batch_size=1000):
+    "Compute phone blind index for users saved before it existed"
+    last_id = 0
+    while True:
+        cursor.execute('''
+            SELECT id, phone FROM users
+            WHERE id > ? AND phone_index IS NULL AND phone IS NOT NULL AND phone != ''
+            ORDER BY id LIMIT ?
+        ''', (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        cursor.executemany("UPDATE users SET phone_index = ? WHERE id = ?",
+                           [(phone_blind_index(decrypt_data(phone)), user_id) for user_id, phone in rows])
+        last_id = rows[-1][0]
+
+
+def insert_route(cursor, tg_id, route):
+    "Insert route with its stops and return the new route id"
+    cursor.execute("INSERT INTO routes (tg_id) VALUES (?)", (tg_id,))
+    route_id = cursor.lastrowid
+
+    cursor.executemany('''
+        INSERT INTO route_stops (route_id, position, name, description, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(route_id, position, obj.get('name'), obj.get('description'), obj.get('latitude'), obj.get('longitude'))
+          for position, obj in enumerate(route)])
+
+    return route_id
+
+
+def fetch_route(cursor, route_id):
+    "Get stops of the route as a list of objects"
+    if route_id is None:
+        return []
+
+    cursor.execute('''
+        SELECT name, description, latitude, longitude FROM route_stops
+        WHERE route_id = ? ORDER BY position
+    ''', (route_id,))
+
+    return [{"name": name, "description": description, "latitude": latitude, "longitude": longitude}
+            for name, description, latitude, longitude in cursor.fetchall()]
 
 
 def save_user(tg_id, name, phone):
     "Save or update user information"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     encrypted_name = encrypt_data(name)
     encrypted_phone = encrypt_data(phone)
 
+    # Upsert keeps the rest of an existing user's row (points, route, ...) untouched
     cursor.execute('''
-        INSERT OR REPLACE INTO users (tg_id, name, phone, points, interests, current_route, visited_objects, route_step)
-        VALUES (?, ?, ?, 
-                COALESCE((SELECT points FROM users WHERE tg_id = ?), 0),
-                COALESCE((SELECT interests FROM users WHERE tg_id = ?), ''),
-                COALESCE((SELECT current_route FROM users WHERE tg_id = ?), ''),
-                COALESCE((SELECT visited_objects FROM users WHERE tg_id = ?), '[]'),
-                COALESCE((SELECT route_step FROM users WHERE tg_id = ?), 0))
-    ''', (tg_id, encrypted_name, encrypted_phone, tg_id, tg_id, tg_id, tg_id, tg_id))
+        INSERT INTO users (tg_id, name, phone, phone_index, points, interests, route_step)
+        VALUES (?, ?, ?, ?, 0, '', 0)
+        ON CONFLICT (tg_id) DO UPDATE
+        SET name = excluded.name, phone = excluded.phone, phone_index = excluded.phone_index
+    ''', (tg_id, encrypted_name, encrypted_phone, phone_blind_index(phone)))
 
     conn.commit()
-    conn.close()
+    invalidate_user(tg_id)
 
 
-def get_user(tg_id):
-    "Get user information"
-    conn = sqlite3.connect(DATABASE_PATH)
+def update_user_phone(tg_id, phone):
+    "Update user phone"
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-    row = cursor.fetchone()
+    cursor.execute("UPDATE users SET phone = ?, phone_index = ? WHERE tg_id = ?",
+                   (encrypt_data(phone), phone_blind_index(phone), tg_id))
+    conn.commit()
+    invalidate_user(tg_id)
 
-    if row:
-        # Decrypt sensitive data
-        decrypted_row = list(row)
-        decrypted_row[2] = decrypt_data(row[2])  # name
-        decrypted_row[3] = decrypt_data(row[3])  # phone
 
-        # Parse JSON fields
-        try:
-            decrypted_row[6] = json.loads(row[6]) if row[6] else []  # current_route
-        except:
-            decrypted_row[6] = []
+def find_users_by_phone(phone, columns=USER_COLUMNS):
+    "Find users with the phone number (any formatting) by its blind index"
+    # Rows not re-encrypted yet after a key rotation still have old key indexes
+    indexes = phone_blind_indexes(phone)
+    if not indexes[0]:
+        return []
 
-        try:
-            decrypted_row[7] = json.loads(row[7]) if row[7] else []  # visited_objects
-        except:
-            decrypted_row[7] = []
+    for column in columns:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown user column: {column}")
 
-        conn.close()
-        return decrypted_row
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT {', '.join(columns)} FROM users WHERE phone_index IN ({', '.join('?' * len(indexes))})",
+                   indexes)
+    return [UserRecord(columns, row) for row in cursor.fetchall()]
+
+
+def get_user(tg_id):
+    "Get user information (UserRecord with all USER_COLUMNS or None)"
+    return cached_user_data(tg_id, 'user', lambda: get_user_fields(tg_id, *USER_COLUMNS))
 
-    conn.close()
-    return None
+
+def get_user_fields(tg_id, *columns):
+    "Get only the given USER_COLUMNS of the user (UserRecord or None)"
+    for column in columns:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown user column: {column}")
+
+    # A cached full record has every column
+    with user_cache_lock:
+        entry = user_cache.get(tg_id)
+        if entry is not None and 'user' in entry:
+            return entry['user']
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT {', '.join(columns)} FROM users WHERE tg_id = ?", (tg_id,))
+    row = cursor.fetchone()
+
+    return UserRecord(columns, row) if row else None
 
 
 def update_user_interests(tg_id, interests):
-    "Update user interests"
-    conn = sqlite3.connect(DATABASE_PATH)
+    "Update user interests (and the interest leaderboards the user is on)"
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("UPDATE users SET interests = ? WHERE tg_id = ?", (interests, tg_id))
+    cursor.execute("DELETE FROM interest_points WHERE tg_id = ?", (tg_id,))
+    cursor.executemany('''
+        INSERT OR IGNORE INTO interest_points (interest, tg_id, points)
+        SELECT ?, tg_id, points FROM users WHERE tg_id = ?
+    ''', [(key, tg_id) for key in interest_keys(interests)])
     conn.commit()
-    conn.close()
+    invalidate_user(tg_id)
 
 
 def update_user_route(tg_id, route):
     "Update user current route"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    route_json = json.dumps(route)
-    cursor.execute("UPDATE users SET current_route = ?, route_step = 0 WHERE tg_id = ?",
-                   (route_json, tg_id))
+    route_id = insert_route(cursor, tg_id, route)
+    cursor.execute("UPDATE users SET current_route_id = ?, route_step = 0 WHERE tg_id = ?",
+                   (route_id, tg_id))
     conn.commit()
-    conn.close()
+    invalidate_user(tg_id)
 
 
 def get_user_route(tg_id):
     "Get user current route"
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT current_route FROM users WHERE tg_id = ?", (tg_id,))
-    row = cursor.fetchone()
-
-    if row and row[0]:
-        try:
-            return json.loads(row[0])
-        except:
-            return []
-
-    conn.close()
-    return []
+    route_state = get_route_state(tg_id)
+    return route_state[1] if route_state else []
 
 
 def update_route_step(tg_id, step):
     "Update current route step"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("UPDATE users SET route_step = ? WHERE tg_id = ?", (step, tg_id))
     conn.commit()
-    conn.close()
+    invalidate_user(tg_id)
 
 
 def get_route_step(tg_id):
     "Get current route step"
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT route_step FROM users WHERE tg_id = ?", (tg_id,))
-    row = cursor.fetchone()
-
-    conn.close()
-    return row[0] if row else 0
+    route_state = get_route_state(tg_id)
+    return route_state[2] if route_state else 0
 
 
 def add_visited_object(tg_id, obj):
     "Add visited object to user's list"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    # Get current visited objects
-    cursor.execute("SELECT visited_objects FROM users WHERE tg_id = ?", (tg_id,))
-    row = cursor.fetchone()
+    cursor.execute('''
+        INSERT INTO visits (tg_id, route_id, name, description, latitude, longitude)
+        SELECT tg_id, current_route_id, ?, ?, ?, ? FROM users WHERE tg_id = ?
+    ''', (obj.get('name'), obj.get('description'), obj.get('latitude'), obj.get('longitude'), tg_id))
+    conn.commit()
+    invalidate_user(tg_id)
 
-    if row:
-        try:
-            visited = json.loads(row[0]) if row[0] else []
-        except:
-            visited = []
 
-        visited.append(obj)
-        visited_json = json.dumps(visited)
+def count_visited_objects(tg_id):
+    "Get number of objects visited by user"
+    conn = get_connection()
+    cursor = conn.cursor()
 
-        cursor.execute("UPDATE users SET visited_objects = ? WHERE tg_id = ?",
-                       (visited_json, tg_id))
-        conn.commit()
+    def load():
+        cursor.execute("SELECT COUNT(*) FROM visits WHERE tg_id = ?", (tg_id,))
+        return cursor.fetchone()[0]
 
-    conn.close()
+    return cached_user_data(tg_id, 'visited_count', load)
 
 
 def add_points(tg_id, points):
     "Add points to user"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("UPDATE users SET points = points + ? WHERE tg_id = ?", (points, tg_id))
     conn.commit()
-    conn.close()
+    invalidate_user(tg_id)
 
 
-def get_all_users():
-    "Get all users (for admin panel)"
-    conn = sqlite3.connect(DATABASE_PATH)
+def get_route_state(tg_id):
+    """Get user current route state: (route_id, route, route_step, free_order, visited positions).
+    None if user is not registered"""
+    return cached_user_data(tg_id, 'route_state', lambda: load_route_state(tg_id))
+
+
+def load_route_state(tg_id):
+    "Load user current route state from the database"
+    conn = get_connection()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM users")
-    rows = cursor.fetchall()
+    cursor.execute('''
+        SELECT u.current_route_id, u.route_step, r.free_order
+        FROM users u LEFT JOIN routes r ON r.id = u.current_route_id
+        WHERE u.tg_id = ?
+    ''', (tg_id,))
+    row = cursor.fetchone()
 
-    # Decrypt sensitive data
-    decrypted_rows = []
-    for row in rows:
-        decrypted_row = list(row)
-        decrypted_row[2] = decrypt_data(row[2])  # name
-        decrypted_row[3] = decrypt_data(row[3])  # phone
-        decrypted_rows.append(decrypted_row)
+    if not row:
+        return None
 
-    conn.close()
-    return decrypted_rows
+    route_id, step, free_order = row
+    cursor.execute("SELECT position FROM route_stops WHERE route_id = ? AND visited = 1", (route_id,))
+    visited = {position for (position,) in cursor.fetchall()}
 
+    return route_id, fetch_route(cursor, route_id), step, bool(free_order), visited
 
-def get_shop_items(active_only=True):
-    "Get all shop items"
-    conn = sqlite3.connect(DATABASE_PATH)
+
+def mark_passed_stops(cursor):
+    """Mark objects before the route step of current routes as visited, for
+    routes started before visits were recorded per object"""
+    cursor.execute('''
+        UPDATE route_stops SET visited = 1
+        FROM users u
+        WHERE u.current_route_id = route_stops.route_id
+          AND route_stops.position < u.route_step AND route_stops.visited = 0
+    ''')
+
+
+def set_route_free_order(tg_id):
+    "Allow visiting objects of user current route in any order"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        UPDATE routes SET free_order = 1
+        WHERE id = (SELECT current_route_id FROM users WHERE tg_id = ?)
+    ''', (tg_id,))
+    changed = cursor.rowcount == 1
+    if changed:
+        # Objects passed in the given order must not be paid for again
+        cursor.execute('''
+            UPDATE route_stops SET visited = 1
+            WHERE route_id = (SELECT current_route_id FROM users WHERE tg_id = ?)
+              AND position < (SELECT route_step FROM users WHERE tg_id = ?) AND visited = 0
+        ''', (tg_id, tg_id))
+    conn.commit()
+    invalidate_user(tg_id)
+    return changed
+
+
+def record_visit(tg_id, expected_step, obj, points):
+    """Record a visit to the route object, add points and advance the route step
+    in one transaction. Does nothing and returns False if the route step is no
+    longer expected_step (e.g. the same object was already counted)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        # Take the write lock up front, the step check and the writes see the same state
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            UPDATE users SET points = points + ?, route_step = route_step + 1
+            WHERE tg_id = ? AND route_step = ?
+        ''', (points, tg_id, expected_step))
+
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return False
+
+        cursor.execute('''
+            INSERT INTO visits (tg_id, route_id, name, description, latitude, longitude)
+            SELECT tg_id, current_route_id, ?, ?, ?, ? FROM users WHERE tg_id = ?
+        ''', (obj.get('name'), obj.get('description'), obj.get('latitude'), obj.get('longitude'), tg_id))
+        cursor.execute('''
+            UPDATE route_stops SET visited = 1
+            WHERE route_id = (SELECT current_route_id FROM users WHERE tg_id = ?) AND position = ?
+        ''', (tg_id, expected_step))
+        conn.commit()
+        return True
+    except:
+        conn.rollback()
+        raise
+    finally:
+        # Also drop the entry when the step did not match, it may be stale
+        invalidate_user(tg_id)
+
+
+def record_free_visits(tg_id, route_id, positions, points_per_object):
+    """Record visits to several objects of a free order route, add points and
+    advance the route step in one transaction. Objects already visited are skipped.
+    Returns positions of the newly visited objects"""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        recorded = []
+        for position in positions:
+            cursor.execute('''
+                UPDATE route_stops SET visited = 1
+                WHERE route_id = ? AND position = ? AND visited = 0
+            ''', (route_id, position))
+            if cursor.rowcount == 1:
+                recorded.append(position)
+
+        if not recorded:
+            conn.rollback()
+            return []
+
+        # The route may have been replaced in the meantime
+        cursor.execute('''
+            UPDATE users SET points = points + ?, route_step = route_step + ?
+            WHERE tg_id = ? AND current_route_id = ?
+        ''', (points_per_object * len(recorded), len(recorded), tg_id, route_id))
+
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return []
+
+        cursor.executemany('''
+            INSERT INTO visits (tg_id, route_id, name, description, latitude, longitude)
+            SELECT ?, route_id, name, description, latitude, longitude FROM route_stops
+            WHERE route_id = ? AND position = ?
+        ''', [(tg_id, route_id, position) for position in recorded])
+        conn.commit()
+        return recorded
+    except:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_user(tg_id)
+
+
+def get_leaderboard(tg_id, board='all', limit=10):
+    """Get a leaderboard: 'all' (current points), 'week' (points earned this week)
+    or 'interest:<stem>' (users with the interest, see interest_keys).
+    Returns (top as [(name, points)], user rank or None, user points, number of
+    users on the leaderboard). The top is read through a points index, the rank
+    sums the users per points value above the user from points_counts"""
+    conn = get_connection()
     cursor = conn.cursor()
 
-    if active_only:
-        cursor.execute("SELECT * FROM shop_items WHERE is_active = 1 ORDER BY price")
+    if board == 'all':
+        source, condition, params = "users", "1", []
+    elif board == 'week':
+        cursor.execute(f"SELECT {CURRENT_WEEK}")
+        week = cursor.fetchone()[0]
+        board = f"week:{week}"
+        source, condition, params = "weekly_points", "s.week = ?", [week]
+    elif board.startswith('interest:'):
+        source, condition, params = "interest_points", "s.interest = ?", [board[len('interest:'):]]
     else:
+        raise ValueError(f"Unknown leaderboard: {board}")
+
+    cursor.execute(f'''
+        SELECT u.name, s.points FROM {source} s JOIN users u ON u.tg_id = s.tg_id
+        WHERE {condition} ORDER BY s.points DESC LIMIT ?
+    ''', (*params, limit))
+    top = [(decrypt_data(name), points) for name, points in cursor.fetchall()]
+
+    cursor.execute(f"SELECT s.points FROM {source} s WHERE {condition} AND s.tg_id = ?", (*params, tg_id))
+    row = cursor.fetchone()
+    points = row[0] if row else 0
+
+    cursor.execute('''
+        SELECT COALESCE(SUM(CASE WHEN points > ? THEN users END), 0), COALESCE(SUM(users), 0)
+        FROM points_counts WHERE board = ?
+    ''', (points, board))
+    above, total = cursor.fetchone()
+
+    return top, above + 1 if row else None, points, total
+
+
+def get_all_users(columns=('id', 'tg_id', 'name', 'phone', 'points', 'interests')):
+    "Get all users as UserRecords with the given columns (for admin panel)"
+    for column in columns:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown user column: {column}")
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT {', '.join(columns)} FROM users")
+    return [UserRecord(columns, row) for row in cursor.fetchall()]
+
+
+def iter_all_users(columns=('id', 'tg_id', 'name', 'phone', 'points', 'interests'), chunk_size=5000):
+    """Get all users as lists of up to chunk_size UserRecords with name and phone
+    already decrypted. Decryption of big tables is spread over several processes
+    and each chunk is yielded as soon as it is ready"""
+    users = get_all_users(columns)
+
+    has_name, has_phone = 'name' in columns, 'phone' in columns
+    tokens = []
+    for user in users:
+        if has_name:
+            tokens.append(user.name_token)
+        if has_phone:
+            tokens.append(user.phone_token)
+
+    per_user = has_name + has_phone
+    if not per_user:
+        for start in range(0, len(users), chunk_size):
+            yield users[start:start + chunk_size]
+        return
+
+    start = 0
+    for values in decrypt_bulk(tokens, chunk_size * per_user):
+        chunk = users[start:start + len(values) // per_user]
+        for i, user in enumerate(chunk):
+            if has_name:
+                user._name = values[i * per_user]
+            if has_phone:
+                user._phone = values[i * per_user + per_user - 1]
+        start += len(chunk)
+        yield chunk
+
+
+# Columns the users list can be sorted by (name and phone are encrypted)
+USER_SORT_COLUMNS = ('id', 'tg_id', 'points')
+
+
+def users_filter(search):
+    """SQL condition and parameters matching users by the search text: interests
+    with words starting with its words (full text index), Telegram ID or phone
+    number equal to it"""
+    search = (search or "").strip()
+    query = fts_query(search)
+    if not query:
+        return "1", []
+
+    conditions = ["id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"]
+    params = [query]
+
+    if search.isdigit():
+        conditions.append("tg_id = ?")
+        params.append(int(search))
+
+    # Names and phones are encrypted, phones can only be matched as a whole number
+    indexes = phone_blind_indexes(search)
+    if indexes[0]:
+        conditions.append(f"phone_index IN ({', '.join('?' * len(indexes))})")
+        params.extend(indexes)
+
+    return f"({' OR '.join(conditions)})", params
+
+
+def count_users(search=None):
+    "Count users matching the search text (see users_filter)"
+    condition, params = users_filter(search)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT COUNT(*) FROM users WHERE {condition}", params)
+    return cursor.fetchone()[0]
+
+
+def get_users_page(after=None, sort='id', descending=False, search=None, limit=200,
+                   columns=('id', 'tg_id', 'name', 'phone', 'points', 'interests')):
+    """Get one page of users as UserRecords, sorted and filtered in SQL.
+    Pages are read by keyset: after is (sort value, id) of the last user of the
+    previous page, so a page deep in the list costs as much as the first one"""
+    if sort not in USER_SORT_COLUMNS:
+        raise ValueError(f"Users can not be sorted by: {sort}")
+    for column in columns:
+        if column not in USER_COLUMNS:
+            raise ValueError(f"Unknown user column: {column}")
+
+    condition, params = users_filter(search)
+    order = "DESC" if descending else "ASC"
+
+    if after is not None:
+        sign = "<" if descending else ">"
+        if sort == 'id':
+            condition += f" AND id {sign} ?"
+            params.append(after[1])
+        else:
+            condition += f" AND ({sort}, id) {sign} (?, ?)"
+            params.extend(after)
+
+    # Sort column and id are always fetched to build the key of the next page
+    columns = tuple(dict.fromkeys(('id', sort) + tuple(columns)))
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"SELECT {', '.join(columns)} FROM users WHERE {condition} "
+                   f"ORDER BY {sort} {order}, id {order} LIMIT ?", (*params, limit))
+    return [UserRecord(columns, row) for row in cursor.fetchall()]
+
+
+class ShopCatalog:
+    """Snapshot of all shop items (rows sorted by price) at one catalog version.
+    Rows are (id, name, description, price, category, image_url, is_active, stock),
+    stock is None for items without a stock limit"""
+    __slots__ = ('version', 'items', 'active_items', 'by_id')
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.items = tuple(rows)
+        self.active_items = tuple(row for row in rows if row[6])
+        self.by_id = {row[0]: row for row in rows}
+
+
+# Shop catalog of this process, replaced as a whole when the catalog version changes
+shop_catalog = None
+
+
+def get_shop_catalog():
+    """Get the shop catalog. Triggers on shop_items bump the catalog version in
+    the metadata table, so items are only read again after they were changed,
+    also when they were changed by another process (the admin panel)"""
+    global shop_catalog
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT value FROM metadata WHERE key = 'shop_version'")
+    version = cursor.fetchone()[0]
+
+    catalog = shop_catalog
+    if catalog is None or catalog.version != version:
         cursor.execute("SELECT * FROM shop_items ORDER BY price")
+        catalog = shop_catalog = ShopCatalog(version, cursor.fetchall())
 
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    return catalog
+
+
+def get_shop_items(active_only=True):
+    "Get all shop items"
+    catalog = get_shop_catalog()
+    return catalog.active_items if active_only else catalog.items
+
+
+def get_shop_item(item_id):
+    "Get shop item by id (row or None)"
+    return get_shop_catalog().by_id.get(item_id)
+
+
+def search_shop_items(search):
+    "Get shop items with words starting with the words of the search text, best matches first"
+    query = fts_query(search)
+    if not query:
+        return get_shop_items(active_only=False)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT s.* FROM shop_items_fts f JOIN shop_items s ON s.id = f.rowid
+        WHERE shop_items_fts MATCH ? ORDER BY f.rank
+    ''', (query,))
+    return cursor.fetchall()
+
+
+# Results of purchase_item
+PURCHASE_OK = 'ok'
+PURCHASE_DUPLICATE = 'duplicate'
+PURCHASE_NOT_FOUND = 'not_found'
+PURCHASE_OUT_OF_STOCK = 'out_of_stock'
+PURCHASE_NOT_ENOUGH_POINTS = 'not_enough_points'
+
+
+def purchase_item(tg_id, item_id, idempotency_key):
+    """Buy shop item for points: take it from stock (if stock is limited), debit
+    points and record the purchase in one transaction. Points and stock are only
+    changed by conditional updates, so parallel purchases can never overspend.
+    A purchase with an already used idempotency_key (double tap) is not repeated.
+    Returns (PURCHASE_* status, item name or None, user points after it)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        # Take the write lock first, so everything below reads the latest data
+        cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute("SELECT name, price, stock FROM shop_items WHERE id = ? AND is_active = 1", (item_id,))
+        item = cursor.fetchone()
+        name = item[0] if item else None
+
+        cursor.execute("SELECT 1 FROM purchases WHERE idempotency_key = ?", (idempotency_key,))
+        if cursor.fetchone():
+            status = PURCHASE_DUPLICATE
+        elif not item:
+            status = PURCHASE_NOT_FOUND
+        else:
+            price, stock = item[1], item[2]
+            status = PURCHASE_OK
+
+            if stock is not None:
+                cursor.execute("UPDATE shop_items SET stock = stock - 1 WHERE id = ? AND stock > 0", (item_id,))
+                if cursor.rowcount != 1:
+                    status = PURCHASE_OUT_OF_STOCK
+
+            if status == PURCHASE_OK:
+                cursor.execute("UPDATE users SET points = points - ? WHERE tg_id = ? AND points >= ?",
+                               (price, tg_id, price))
+                if cursor.rowcount != 1:
+                    status = PURCHASE_NOT_ENOUGH_POINTS
+
+            if status == PURCHASE_OK:
+                cursor.execute('''
+                    INSERT INTO purchases (tg_id, item_id, name, price, idempotency_key)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (tg_id, item_id, name, price, idempotency_key))
+
+        cursor.execute("SELECT points FROM users WHERE tg_id = ?", (tg_id,))
+        row = cursor.fetchone()
+
+        if status == PURCHASE_OK:
+            conn.commit()
+        else:
+            conn.rollback()
+        return status, name, row[0] if row else 0
+    except:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_user(tg_id)
+
+
+def get_user_purchases(tg_id, limit=20):
+    "Get last purchases of the user: (name, price, created_at) rows, newest first"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT name, price, created_at FROM purchases
+        WHERE tg_id = ? ORDER BY id DESC LIMIT ?
+    ''', (tg_id, limit))
+    return cursor.fetchall()
 
 
-def add_shop_item(name, description, price, category, image_url=None):
-    "Add new shop item"
-    conn = sqlite3.connect(DATABASE_PATH)
+def add_shop_item(name, description, price, category, image_url=None, stock=None):
+    "Add new shop item (stock=None means unlimited)"
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
-        INSERT INTO shop_items (name, description, price, category, image_url, is_active)
-        VALUES (?, ?, ?, ?, ?, 1)
-    ''', (name, description, price, category, image_url))
+        INSERT INTO shop_items (name, description, price, category, image_url, is_active, stock)
+        VALUES (?, ?, ?, ?, ?, 1, ?)
+    ''', (name, description, price, category, image_url, stock))
 
     conn.commit()
-    conn.close()
 
 
-def update_shop_item(item_id, name, description, price, category, image_url=None, is_active=True):
-    "Update shop item"
-    conn = sqlite3.connect(DATABASE_PATH)
+def update_shop_item(item_id, name, description, price, category, image_url=None, is_active=True, stock=None):
+    "Update shop item (stock=None means unlimited)"
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
         UPDATE shop_items 
-        SET name = ?, description = ?, price = ?, category = ?, image_url = ?, is_active = ?
+        SET name = ?, description = ?, price = ?, category = ?, image_url = ?, is_active = ?, stock = ?
         WHERE id = ?
-    ''', (name, description, price, category, image_url, is_active, item_id))
+    ''', (name, description, price, category, image_url, is_active, stock, item_id))
 
     conn.commit()
-    conn.close()
 
 
 def delete_shop_item(item_id):
     "Delete shop item"
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("DELETE FROM shop_items WHERE id = ?", (item_id,))
 
     conn.commit()
-    conn.close()
 
 
 # Initialize database on import
@@ -1,9 +1,110 @@
 # bot/deepseek_integration.py
-from openai import OpenAI
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError
+import asyncio
 import json
-from bot.config import DEEPSEEK_API_KEY
+import logging
+import random
+import time
+from bot.config import (
+    DEEPSEEK_API_KEY, DEEPSEEK_BASE_URL, DEEPSEEK_TIMEOUT,
+    DEEPSEEK_MAX_CONCURRENCY, DEEPSEEK_MAX_RETRIES
+)
+
+# One shared client keeps a pool of HTTP connections for all requests.
+# Retries are done in chat_completion, so the client itself does not retry.
+client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL,
+                     timeout=DEEPSEEK_TIMEOUT, max_retries=0)
+
+# Limits the number of requests in flight at the same time
+api_semaphore = asyncio.Semaphore(DEEPSEEK_MAX_CONCURRENCY)
+
+# Request metrics
+api_stats = {
+    "requests": 0,
+    "retries": 0,
+    "errors": 0,
+    "in_flight": 0,
+    "total_time": 0.0,
+}
+
+
+# Route returned when DeepSeek fails
+FALLBACK_ROUTE = [
+    {
+        "name": "Минск",
+        "description": "Столица Беларуси",
+        "latitude": 53.9045,
+        "longitude": 27.5577
+    }
+]
+
+
+def is_retryable(error):
+    "Check if a failed request is worth retrying (rate limit, server or connection error)"
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+async def chat_completion(system_prompt, user_prompt, max_tokens):
+    "Send chat request to DeepSeek API and return the answer text"
+    for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+        async with api_semaphore:
+            api_stats["requests"] += 1
+            api_stats["in_flight"] += 1
+            started = time.monotonic()
+            try:
+                response = await client.chat.completions.create(
+                    model="deepseek/deepseek-chat",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    stream=False,
+                    temperature=0.7,
+                    max_tokens=max_tokens
+                )
+                return response.choices[0].message.content.strip()
+            except Exception as e:
+                if attempt == DEEPSEEK_MAX_RETRIES or not is_retryable(e):
+                    api_stats["errors"] += 1
+                    raise
+                api_stats["retries"] += 1
+            finally:
+                api_stats["in_flight"] -= 1
+                api_stats["total_time"] += time.monotonic() - started
+
+        # Exponential backoff with full jitter, without holding a request slot
+        await asyncio.sleep(random.uniform(0, 2 ** attempt))
+
+
+def api_metrics():
+    "DeepSeek request metrics with the average request time"
+    requests = api_stats["requests"]
+    return {**api_stats, "avg_time": api_stats["total_time"] / requests if requests else 0.0}
+
+
+async def log_api_stats(interval):
+    "Log DeepSeek metrics every interval seconds when there were requests"
+    logged = 0
+    while True:
+        await asyncio.sleep(interval)
+        if api_stats["requests"] != logged:
+            logged = api_stats["requests"]
+            logging.info("DeepSeek: %s", ", ".join(
+                f"{name} {value:.2f}" if isinstance(value, float) else f"{name} {value}"
+                for name, value in api_metrics().items()))
+
+
+def strip_json_fences(content):
+    "Remove markdown code fences around JSON answer"
+    if content.startswith('```json'):
+        content = content[7:]  # Remove ```json
+    if content.endswith('```'):
+        content = content[:-3]  # Remove ```
+    return content
+
 
-client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://openrouter.ai/api/v1")
 def load_prompt(filename):
     "Load prompt from file"
     try:
@@ -12,7 +113,7 @@ def load_prompt(filename):
     except FileNotFoundError:
         return ""
 
-def get_route_from_deepseek(interests: str, count: int):
+async def get_route_from_deepseek(interests: str, count: int):
     "Generate route using DeepSeek API"
     prompt_template = load_prompt("route_prompt.txt")
     if not prompt_template:
@@ -34,24 +135,12 @@ def get_route_from_deepseek(interests: str, count: int):
     prompt = prompt_template.format(interests=interests, count=count)
 
     try:
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-chat",
-            messages=[
-                {"role": "system", "content": "Ты полезный помощник, который создает туристические маршруты."},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False,
-            temperature=0.7,
-            max_tokens=2000
+        content = await chat_completion(
+            "Ты полезный помощник, который создает туристические маршруты.", prompt, 2000
         )
 
-        content = response.choices[0].message.content.strip()
-
         # Try to extract JSON from response
-        if content.startswith('```json'):
-            content = content[7:]  # Remove ```json
-        if content.endswith('```'):
-            content = content[:-3]  # Remove ```
+        content = strip_json_fences(content)
 
         # Parse JSON
         route_data = json.loads(content)
@@ -61,27 +150,13 @@ def get_route_from_deepseek(interests: str, count: int):
         print(f"JSON decode error: {e}")
         print(f"Response content: {content}")
         # Return fallback route
-        return [
-            {
-                "name": "Минск",
-                "description": "Столица Беларуси",
-                "latitude": 53.9045,
-                "longitude": 27.5577
-            }
-        ]
+        return list(FALLBACK_ROUTE)
     except Exception as e:
         print(f"DeepSeek API error: {e}")
         # Return fallback route
-        return [
-            {
-                "name": "Минск",
-                "description": "Столица Беларуси",
-                "latitude": 53.9045,
-                "longitude": 27.5577
-            }
-        ]
+        return list(FALLBACK_ROUTE)
 
-def get_interests_suggestions(user_input: str):
+async def get_interests_suggestions(user_input: str):
     "Get interests suggestions using DeepSeek API"
     prompt_template = load_prompt("interests_prompt.txt")
     if not prompt_template:
@@ -94,24 +169,12 @@ def get_interests_suggestions(user_input: str):
     prompt = prompt_template.format(input=user_input)
 
     try:
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-chat",
-            messages=[
-                {"role": "system", "content": "Ты полезный помощник, который уточняет интересы пользователя."},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False,
-            temperature=0.7,
-            max_tokens=500
+        content = await chat_completion(
+            "Ты полезный помощник, который уточняет интересы пользователя.", prompt, 500
         )
 
-        content = response.choices[0].message.content.strip()
-
         # Try to extract JSON from response
-        if content.startswith('```json'):
-            content = content[7:]  # Remove ```json
-        if content.endswith('```'):
-            content = content[:-3]  # Remove ```
+        content = strip_json_fences(content)
 
         # Parse JSON
         interests_list = json.loads(content)
@@ -0,0 +1,109 @@
+# bot/fsm_storage.py
+import json
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY
+
+from bot.config import FSM_STATE_TTL
+from bot.crypto_utils import encrypt_data, decrypt_data
+from bot.database import get_connection, run_db
+
+
+def storage_key(key):
+    "Compact row key of the FSM context: bot:chat:user, thread, business connection and destiny only when set"
+    parts = [key.bot_id, key.chat_id, key.user_id]
+    if key.thread_id or key.business_connection_id or key.destiny != DEFAULT_DESTINY:
+        parts += [key.thread_id or '', key.business_connection_id or '', key.destiny]
+    return ':'.join(map(str, parts))
+
+
+def dump_data(data):
+    "Compact JSON of the data, encrypted. Empty data is not stored"
+    if not data:
+        return None
+    return encrypt_data(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+
+def load_data(token):
+    if not token:
+        return {}
+    try:
+        return json.loads(decrypt_data(token))
+    except ValueError:
+        # Encrypted with a key that is not configured anymore
+        return {}
+
+
+def load_row(row_key, column):
+    "Read state or data of the context, None when there is none or it expired"
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {column} FROM fsm_storage WHERE key = ? AND updated_at > ?",
+                   (row_key, int(time.time()) - FSM_STATE_TTL))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def save_row(cursor, row_key, column, value):
+    """Store state or data of the context. Rows without state and data are deleted
+    and expired rows of all contexts are dropped"""
+    now = int(time.time())
+    cursor.execute(f'''
+        INSERT INTO fsm_storage (key, {column}, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+    ''', (row_key, value, now))
+    cursor.execute("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data IS NULL", (row_key,))
+    cursor.execute("DELETE FROM fsm_storage WHERE updated_at <= ?", (now - FSM_STATE_TTL,))
+
+
+def save_state(row_key, state):
+    conn = get_connection()
+    save_row(conn.cursor(), row_key, 'state', state)
+    conn.commit()
+
+
+def save_data(row_key, data):
+    conn = get_connection()
+    save_row(conn.cursor(), row_key, 'data', dump_data(data))
+    conn.commit()
+
+
+def merge_data(row_key, data):
+    """Update data of the context in one transaction, so concurrent updates from
+    other bot processes are not lost. Returns the new data"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        merged = load_data(load_row(row_key, 'data'))
+        merged.update(data)
+        save_row(cursor, row_key, 'data', dump_data(merged))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return merged
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in the bot database. Dialog states survive restarts and are
+    shared by all bot processes using the same database"""
+
+    async def set_state(self, key, state=None):
+        await run_db(save_state, storage_key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        return await run_db(load_row, storage_key(key), 'state')
+
+    async def set_data(self, key, data):
+        await run_db(save_data, storage_key(key), dict(data))
+
+    async def get_data(self, key):
+        return load_data(await run_db(load_row, storage_key(key), 'data'))
+
+    async def update_data(self, key, data):
+        return await run_db(merge_data, storage_key(key), dict(data))
+
+    async def close(self):
+        pass
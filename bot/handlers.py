@@ -1,20 +1,26 @@
 # bot/handlers.py
 from aiogram import Router, F
-from aiogram.types import Message, Location
+from aiogram.types import Message, Location, CallbackQuery
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 import json
 
 from bot.database import (
-    save_user, get_user, update_user_interests, update_user_route,
-    get_user_route, update_route_step, get_route_step,
-    add_visited_object, add_points, get_shop_items
+    save_user, get_user, get_user_fields, update_user_interests, update_user_route, update_user_phone,
+    get_user_route, update_route_step, count_visited_objects,
+    get_route_state, record_visit, record_free_visits, set_route_free_order,
+    get_shop_catalog, purchase_item, get_user_purchases, get_leaderboard, run_db,
+    PURCHASE_OK, PURCHASE_DUPLICATE, PURCHASE_OUT_OF_STOCK, PURCHASE_NOT_ENOUGH_POINTS
 )
-from bot.deepseek_integration import get_route_from_deepseek, get_interests_suggestions
-from bot.location_utils import is_location_match, format_coordinates, calculate_distance
+from bot.interests_cache import get_suggestions, interest_words
+from bot.route_cache import get_route
+from bot.poi_catalog import build_catalog_route
+from bot.route_optimizer import optimize_route_order
+from bot.live_location import check_live_location, reset_live_session
+from bot.location_utils import is_location_match, format_coordinates, calculate_distance, match_route_stops
 from bot.keyboards import (
     get_main_keyboard, get_profile_keyboard, get_settings_keyboard,
-    get_route_settings_keyboard, get_shop_keyboard, get_back_keyboard,
+    get_route_settings_keyboard, get_shop_keyboard, get_purchase_keyboard, get_back_keyboard,
     get_confirmation_keyboard, get_interests_suggestion_keyboard
 )
 from bot.config import POINTS_PER_OBJECT, LOCATION_ACCURACY
@@ -35,7 +41,7 @@ class UserStates(StatesGroup):
 
 @router.message(F.text == "/start")
 async def cmd_start(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
+    user = await run_db(get_user_fields, message.from_user.id, 'id')
     if user:
         await message.answer("👋 С возвращением! Выберите действие:", reply_markup=get_main_keyboard())
     else:
@@ -56,7 +62,7 @@ async def process_phone(message: Message, state: FSMContext):
     name = data.get('name')
     phone = message.text
 
-    save_user(message.from_user.id, name, phone)
+    await run_db(save_user, message.from_user.id, name, phone)
     await message.answer(f"Спасибо, {name}! Теперь расскажите о ваших интересах (например: музеи, парки, архитектура):")
     await state.set_state(UserStates.waiting_for_interests)
 
@@ -64,9 +70,9 @@ async def process_phone(message: Message, state: FSMContext):
 @router.message(UserStates.waiting_for_interests)
 async def process_interests(message: Message, state: FSMContext):
     interests = message.text
-    # Get suggestions from DeepSeek
+    # Get suggestions from the cache or DeepSeek
     try:
-        suggestions = get_interests_suggestions(interests)
+        suggestions = await get_suggestions(interests)
         if suggestions and len(suggestions) > 0:
             await message.answer("Вот уточненные интересы. Выберите подходящие или нажмите 'Готово':",
                                  reply_markup=get_interests_suggestion_keyboard(suggestions))
@@ -76,7 +82,7 @@ async def process_interests(message: Message, state: FSMContext):
     except:
         pass
 
-    update_user_interests(message.from_user.id, interests)
+    await run_db(update_user_interests, message.from_user.id, interests)
     await message.answer("✅ Ваши интересы сохранены!", reply_markup=get_main_keyboard())
     await state.clear()
 
@@ -88,12 +94,12 @@ async def process_interests_selection(message: Message, state: FSMContext):
         selected_interests = data.get('selected_interests', [])
         if selected_interests:
             interests_str = ", ".join(selected_interests)
-            update_user_interests(message.from_user.id, interests_str)
+            await run_db(update_user_interests, message.from_user.id, interests_str)
             await message.answer(f"✅ Ваши интересы обновлены: {interests_str}", reply_markup=get_main_keyboard())
         else:
             # Use original interests
             original = data.get('original_interests', '')
-            update_user_interests(message.from_user.id, original)
+            await run_db(update_user_interests, message.from_user.id, original)
             await message.answer(f"✅ Ваши интересы сохранены: {original}", reply_markup=get_main_keyboard())
         await state.clear()
     elif message.text in (await state.get_data()).get('interests_suggestions', []):
@@ -115,8 +121,8 @@ async def process_interests_selection(message: Message, state: FSMContext):
 
 @router.message(F.text == "🧭 Подобрать маршрут")
 async def start_route_creation(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
-    if not user or not user[5]:  # interests
+    user = await run_db(get_user_fields, message.from_user.id, 'interests')
+    if not user or not user.interests:
         await message.answer("Сначала укажите ваши интересы в настройках!")
         return
 
@@ -137,17 +143,22 @@ async def process_route_count(message: Message, state: FSMContext):
 
     await state.update_data(route_count=count)
 
-    user = get_user(message.from_user.id)
-    interests = user[5]  # interests column
+    user = await run_db(get_user_fields, message.from_user.id, 'interests')
+    interests = user.interests
 
     await message.answer("🕐 Создаю маршрут, это может занять немного времени...")
 
-    # Generate route using DeepSeek
-    route = get_route_from_deepseek(interests, count)
+    # Build route from the local catalog, fall back to DeepSeek (or the route cache)
+    route = await run_db(build_catalog_route, interests, count)
+    if not route:
+        route = await get_route(interests, count)
 
     if route:
-        update_user_route(message.from_user.id, route)
-        update_route_step(message.from_user.id, 0)
+        # Order objects so that the walk between them is short
+        route = optimize_route_order(route)
+        await run_db(update_user_route, message.from_user.id, route)
+        await run_db(update_route_step, message.from_user.id, 0)
+        reset_live_session(message.from_user.id)
 
         route_text = "Ваш маршрут:\n\n"
         for i, obj in enumerate(route, 1):
@@ -167,14 +178,13 @@ async def process_location(message: Message, state: FSMContext):
     user_lat = message.location.latitude
     user_lon = message.location.longitude
 
-    # Получаем текущего пользователя и его маршрут
-    user = get_user(message.from_user.id)
-    if not user:
+    # Получаем маршрут пользователя и текущий шаг одним запросом
+    route_state = await run_db(get_route_state, message.from_user.id)
+    if not route_state:
         await message.answer("Пожалуйста, сначала зарегистрируйтесь с помощью /start")
         return
 
-    route = get_user_route(message.from_user.id)
-    step = get_route_step(message.from_user.id)
+    route_id, route, step, free_order, visited = route_state
 
     # Проверяем, есть ли активный маршрут
     if not route or len(route) == 0:
@@ -190,6 +200,10 @@ async def process_location(message: Message, state: FSMContext):
         await state.clear()
         return
 
+    if free_order:
+        await process_free_order_location(message, state, route_id, route, visited, user_lat, user_lon)
+        return
+
     # Получаем текущий объект маршрута
     current_object = route[step]
     target_lat = current_object['latitude']
@@ -202,17 +216,19 @@ async def process_location(message: Message, state: FSMContext):
 
     # Проверяем совпадение координат
     if is_location_match(user_lat, user_lon, target_lat, target_lon):
-        # Координаты совпадают - засчитываем посещение
-        add_visited_object(message.from_user.id, current_object)
-        add_points(message.from_user.id, POINTS_PER_OBJECT)
+        # Координаты совпадают - засчитываем посещение, начисляем баллы
+        # и переходим к следующему объекту одной транзакцией
+        recorded = await run_db(record_visit, message.from_user.id, step, current_object, POINTS_PER_OBJECT)
+        if not recorded:
+            # Этот объект уже засчитан параллельно пришедшим сообщением
+            await message.answer(f"Объект {object_name} уже засчитан.", reply_markup=get_route_settings_keyboard())
+            return
 
         success_message = f"✅ Поздравляем! Вы достигли объекта: {object_name}\n"
         success_message += f"📍 Точность: в пределах {LOCATION_ACCURACY} метров\n"
         success_message += f"💰 +{POINTS_PER_OBJECT} баллов\n\n"
 
-        # Переходим к следующему объекту
         next_step = step + 1
-        update_route_step(message.from_user.id, next_step)
 
         if next_step < len(route):
             # Есть еще объекты в маршруте
@@ -239,11 +255,99 @@ async def process_location(message: Message, state: FSMContext):
         await message.answer(fail_message, reply_markup=get_route_settings_keyboard())
 
 
+async def process_free_order_location(message, state, route_id, route, visited, user_lat, user_lon):
+    "Засчитывает все непосещенные объекты маршрута со свободным порядком рядом с пользователем"
+    remaining = [position for position in range(len(route)) if position not in visited]
+
+    # Сравниваем координаты сразу со всеми оставшимися объектами
+    matched, nearest, distance = match_route_stops(user_lat, user_lon, route_id, route, remaining)
+
+    if not matched:
+        nearest_object = route[nearest]
+        fail_message = f"📍 Ваши координаты: {format_coordinates(user_lat, user_lon)}\n\n"
+        fail_message += f"❌ Рядом нет объектов маршрута\n"
+        fail_message += f"📏 Ближайший объект: {nearest_object['name']}, {distance:.0f} метров\n"
+        fail_message += f"🎯 Требуемая точность: {LOCATION_ACCURACY} метров\n\n"
+        fail_message += "Попробуйте подойти ближе и отправить местоположение снова."
+        await message.answer(fail_message, reply_markup=get_route_settings_keyboard())
+        return
+
+    recorded = await run_db(record_free_visits, message.from_user.id, route_id, matched, POINTS_PER_OBJECT)
+    if not recorded:
+        # Объекты уже засчитаны параллельно пришедшим сообщением
+        await message.answer("Эти объекты уже засчитаны.", reply_markup=get_route_settings_keyboard())
+        return
+
+    success_message = "✅ Поздравляем! Вы достигли объектов:\n"
+    for position in recorded:
+        success_message += f"- {route[position]['name']}\n"
+    success_message += f"📍 Точность: в пределах {LOCATION_ACCURACY} метров\n"
+    success_message += f"💰 +{POINTS_PER_OBJECT * len(recorded)} баллов\n\n"
+
+    # Считаем по сохраненному состоянию: часть объектов могла засчитать трансляция геопозиции
+    route_state = await run_db(get_route_state, message.from_user.id)
+    left = len(route) - len(route_state[4]) if route_state and route_state[0] == route_id else 0
+    if left > 0:
+        success_message += f"Осталось объектов: {left}"
+        await message.answer(success_message, reply_markup=get_route_settings_keyboard())
+    else:
+        # Маршрут завершен
+        total_points = len(route) * POINTS_PER_OBJECT
+        success_message += f"🎉 Поздравляем! Вы завершили весь маршрут!\n"
+        success_message += f"Всего получено: {total_points} баллов"
+        await message.answer(success_message, reply_markup=get_main_keyboard())
+        await state.clear()
+
+
+@router.edited_message(F.location)
+async def process_live_location(message: Message, state: FSMContext):
+    "Обработка обновлений трансляции геопозиции: посещения засчитываются автоматически"
+    result = await check_live_location(message.from_user.id, message.location.latitude,
+                                       message.location.longitude)
+    if not result:
+        return
+
+    route, recorded, finished = result
+    success_message = "✅ Поздравляем! Вы достигли объектов:\n"
+    for position in recorded:
+        success_message += f"- {route[position]['name']}\n"
+    success_message += f"💰 +{POINTS_PER_OBJECT * len(recorded)} баллов\n\n"
+
+    if finished:
+        total_points = len(route) * POINTS_PER_OBJECT
+        success_message += f"🎉 Поздравляем! Вы завершили весь маршрут!\n"
+        success_message += f"Всего получено: {total_points} баллов"
+        await message.answer(success_message, reply_markup=get_main_keyboard())
+        await state.clear()
+    else:
+        success_message += "Продолжайте маршрут, следующие объекты будут засчитаны автоматически."
+        await message.answer(success_message, reply_markup=get_route_settings_keyboard())
+
+
+@router.message(F.text == "🔀 Любой порядок объектов")
+async def enable_free_order(message: Message):
+    route_state = await run_db(get_route_state, message.from_user.id)
+    if route_state and route_state[1] and route_state[2] >= len(route_state[1]):
+        await message.answer("Вы уже завершили этот маршрут! Создайте новый маршрут.",
+                             reply_markup=get_main_keyboard())
+        return
+
+    if await run_db(set_route_free_order, message.from_user.id):
+        reset_live_session(message.from_user.id)
+        await message.answer("Теперь объекты маршрута можно посещать в любом порядке. "
+                             "Отправьте местоположение рядом с любым из них.",
+                             reply_markup=get_route_settings_keyboard())
+    else:
+        await message.answer("У вас нет активного маршрута. Сначала создайте маршрут.",
+                             reply_markup=get_main_keyboard())
+
+
 @router.message(F.text == "📍 Отправить местоположение")
 async def request_location(message: Message):
     """Запрос координат у пользователя"""
     await message.answer(
-        "Пожалуйста, отправьте ваше текущее местоположение, нажав на скрепку и выбрав 'Геопозиция' или 'Location'")
+        "Пожалуйста, отправьте ваше текущее местоположение, нажав на скрепку и выбрав 'Геопозиция' или 'Location'. "
+        "Если включить трансляцию геопозиции, объекты будут засчитываться автоматически.")
 
 
 @router.message(F.text == "🔢 Изменить количество объектов")
@@ -254,23 +358,28 @@ async def change_route_count(message: Message, state: FSMContext):
 
 @router.message(F.text == "🔄 Пересоздать маршрут")
 async def recreate_route(message: Message, state: FSMContext):
-    user = get_user(message.from_user.id)
-    if not user or not user[5]:  # interests
+    user = await run_db(get_user_fields, message.from_user.id, 'interests')
+    if not user or not user.interests:
         await message.answer("Сначала укажите ваши интересы в настройках!")
         return
 
     # Получаем предыдущее количество объектов или ставим 5 по умолчанию
-    route = get_user_route(message.from_user.id)
+    route = await run_db(get_user_route, message.from_user.id)
     count = len(route) if route and len(route) > 0 else 5
 
     await message.answer(f"Создаю новый маршрут с {count} объектами...")
 
-    # Generate route using DeepSeek
-    route = get_route_from_deepseek(user[5], count)
+    # Build a new route from the local catalog, fall back to DeepSeek bypassing the route cache
+    route = await run_db(build_catalog_route, user.interests, count, shuffle=True)
+    if not route:
+        route = await get_route(user.interests, count, fresh=True)
 
     if route:
-        update_user_route(message.from_user.id, route)
-        update_route_step(message.from_user.id, 0)
+        # Order objects so that the walk between them is short
+        route = optimize_route_order(route)
+        await run_db(update_user_route, message.from_user.id, route)
+        await run_db(update_route_step, message.from_user.id, 0)
+        reset_live_session(message.from_user.id)
 
         route_text = "Новый маршрут:\n\n"
         for i, obj in enumerate(route, 1):
@@ -286,56 +395,172 @@ async def recreate_route(message: Message, state: FSMContext):
 
 @router.message(F.text == "👤 Мой профиль")
 async def show_profile(message: Message):
-    user = get_user(message.from_user.id)
+    user = await run_db(get_user, message.from_user.id)
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
         return
 
     # Получаем информацию о текущем маршруте
-    route = get_user_route(message.from_user.id)
-    step = get_route_step(message.from_user.id)
+    route_id, route, step, free_order, visited = await run_db(get_route_state, message.from_user.id)
+    visited_count = await run_db(count_visited_objects, message.from_user.id)
 
     profile_text = f"""
 👤 Профиль:
-Имя: {user[2]}
-Телефон: {user[3]}
-Баллы: {user[4]}
+Имя: {user.name}
+Телефон: {user.phone}
+Баллы: {user.points}
 
 📊 Статистика:
-- Посещенные объекты: {len(user[7]) if user[7] else 0}
+- Посещенные объекты: {visited_count}
 """
 
     # Добавляем информацию о текущем маршруте
     if route and len(route) > 0:
         if step < len(route):
-            current_object = route[step]
             profile_text += f"\n🧭 Текущий маршрут: {len(route)} объектов\n"
-            profile_text += f"📍 Текущий объект: {current_object['name']} ({step + 1}/{len(route)})"
+            if free_order:
+                profile_text += f"🔀 Любой порядок, осталось объектов: {len(route) - len(visited)}"
+            else:
+                current_object = route[step]
+                profile_text += f"📍 Текущий объект: {current_object['name']} ({step + 1}/{len(route)})"
         else:
             profile_text += f"\n✅ Маршрут завершен: {len(route)} объектов"
 
     await message.answer(profile_text, reply_markup=get_profile_keyboard())
 
 
-@router.message(F.text == "📊 Мои баллы")
+@router.message(F.text.in_({"📊 Мои баллы", "🏅 Мои баллы"}))
 async def show_points(message: Message):
-    user = get_user(message.from_user.id)
+    user = await run_db(get_user_fields, message.from_user.id, 'points')
     if user:
-        await message.answer(f"Ваши баллы: {user[4]}", reply_markup=get_main_keyboard())
+        await message.answer(f"Ваши баллы: {user.points}", reply_markup=get_main_keyboard())
+
+
+def load_leaderboards(tg_id, interests):
+    """Load global, weekly and interest leaderboards of the user in one database call.
+    Returns (global, weekly, [(interest word, leaderboard)])"""
+    # Same stems the interest leaderboards are kept by (database.interest_keys)
+    boards = [(word, get_leaderboard(tg_id, f"interest:{word_stem}", limit=0))
+              for word_stem, word in interest_words(interests)]
+
+    return get_leaderboard(tg_id, 'all'), get_leaderboard(tg_id, 'week'), boards
+
+
+def format_leaderboard(title, leaderboard):
+    "Format top users and the user's place"
+    top, rank, points, total = leaderboard
+    text = f"{title}\n"
+    for place, (name, user_points) in enumerate(top, 1):
+        text += f"{place}. {name} - {user_points}\n"
+    if rank:
+        text += f"Ваше место: {rank} из {total} ({points} баллов)\n"
+    return text
+
+
+@router.message(F.text == "🏆 Рейтинг")
+async def show_leaderboard(message: Message):
+    user = await run_db(get_user_fields, message.from_user.id, 'interests')
+    if not user:
+        await message.answer("Сначала пройдите регистрацию: /start")
+        return
+
+    overall, weekly, interest_boards = await run_db(load_leaderboards, message.from_user.id, user.interests)
+
+    leaderboard_text = format_leaderboard("🏆 Лучшие по баллам:", overall)
+    if weekly[0]:
+        leaderboard_text += "\n" + format_leaderboard("📅 Лучшие за неделю:", weekly)
+        if not weekly[1]:
+            leaderboard_text += "На этой неделе вы еще не получали баллов\n"
+
+    # Boards the user is not on yet (interests changed a moment ago) are not shown
+    interest_boards = [(word, board) for word, board in interest_boards if board[1]]
+    if interest_boards:
+        leaderboard_text += "\n🎯 Ваше место по интересам:\n"
+        for word, (top, rank, points, total) in interest_boards:
+            leaderboard_text += f"{word}: {rank} из {total}\n"
+
+    await message.answer(leaderboard_text, reply_markup=get_profile_keyboard())
+
+
+# Shop text rendered for one catalog version: (version, text)
+shop_text_cache = (None, None)
+
+
+def get_shop_text(catalog):
+    "Get shop text for the catalog, rendered once per catalog version"
+    global shop_text_cache
+    version, text = shop_text_cache
+    if version != catalog.version:
+        text = "🏪 Магазин:\n\n"
+        for item in catalog.active_items:
+            if item[7] is None:
+                stock = ""
+            elif item[7] > 0:
+                stock = f" (осталось {item[7]})"
+            else:
+                stock = " (нет в наличии)"
+            text += f"{item[1]} - {item[3]} баллов{stock}\n{item[2]}\n\n"
+        shop_text_cache = (catalog.version, text)
+    return text
 
 
 @router.message(F.text == "🏪 Магазин")
 async def show_shop(message: Message):
-    items = get_shop_items()
-    if not items:
+    catalog = await run_db(get_shop_catalog)
+    if not catalog.active_items:
         await message.answer("В магазине пока нет товаров", reply_markup=get_main_keyboard())
         return
 
-    shop_text = "🏪 Магазин:\n\n"
-    for item in items:
-        shop_text += f"{item[1]} - {item[3]} баллов\n{item[2]}\n\n"
+    await message.answer(get_shop_text(catalog), reply_markup=get_shop_keyboard())
+
+
+@router.message(F.text == "🛒 Все товары")
+async def show_shop_items(message: Message):
+    catalog = await run_db(get_shop_catalog)
+    if not catalog.active_items:
+        await message.answer("В магазине пока нет товаров", reply_markup=get_shop_keyboard())
+        return
+
+    keyboard = get_purchase_keyboard(catalog.active_items)
+    if not keyboard.inline_keyboard:
+        # Everything is sold out
+        keyboard = get_shop_keyboard()
+    await message.answer(get_shop_text(catalog), reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("buy:"))
+async def buy_item(callback: CallbackQuery):
+    item_id = int(callback.data.split(":", 1)[1])
+    # Repeated taps on the same button of the same shop message buy only once
+    idempotency_key = f"{callback.from_user.id}:{callback.message.message_id}:{item_id}"
+    status, name, points = await run_db(purchase_item, callback.from_user.id, item_id, idempotency_key)
+
+    if status == PURCHASE_OK:
+        await callback.answer()
+        await callback.message.answer(f"✅ Вы купили «{name}»!\nОсталось баллов: {points}",
+                                      reply_markup=get_shop_keyboard())
+    elif status == PURCHASE_DUPLICATE:
+        await callback.answer("Эта покупка уже оформлена")
+    elif status == PURCHASE_OUT_OF_STOCK:
+        await callback.answer(f"«{name}» закончился", show_alert=True)
+    elif status == PURCHASE_NOT_ENOUGH_POINTS:
+        await callback.answer(f"Недостаточно баллов. Ваши баллы: {points}", show_alert=True)
+    else:
+        await callback.answer("Товар больше не продается", show_alert=True)
+
+
+@router.message(F.text.in_({"📦 Мои покупки", "🛍️ Мои покупки"}))
+async def show_purchases(message: Message):
+    purchases = await run_db(get_user_purchases, message.from_user.id)
+    if not purchases:
+        await message.answer("У вас пока нет покупок", reply_markup=get_shop_keyboard())
+        return
+
+    purchases_text = "📦 Ваши покупки:\n\n"
+    for name, price, created_at in purchases:
+        purchases_text += f"{name} - {price} баллов ({created_at[:16]})\n"
 
-    await message.answer(shop_text, reply_markup=get_shop_keyboard())
+    await message.answer(purchases_text, reply_markup=get_shop_keyboard())
 
 
 @router.message(F.text == "⚙️ Настройки")
@@ -357,7 +582,7 @@ async def change_phone(message: Message, state: FSMContext):
 
 @router.message(UserStates.changing_phone)
 async def process_phone_change(message: Message, state: FSMContext):
-    # In a real app, you would update the phone in the database
+    await run_db(update_user_phone, message.from_user.id, message.text)
     await message.answer("Номер телефона обновлен!", reply_markup=get_main_keyboard())
     await state.clear()
 
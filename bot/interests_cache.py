@@ -0,0 +1,236 @@
+# bot/interests_cache.py
+import json
+import os
+import re
+from collections import OrderedDict
+
+from bot.config import INTERESTS_CACHE_SIZE
+from bot.database import get_connection, run_db
+from bot.deepseek_integration import get_interests_suggestions
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'prompts')
+
+# Russian endings stripped to get a rough word stem, longest first
+ENDINGS = sorted([
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ах', 'ях', 'ов', 'ев', 'ей', 'ой', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее',
+    'ые', 'ие', 'ам', 'ям', 'ом', 'ем', 'ую', 'юю',
+    'а', 'я', 'о', 'е', 'и', 'ы', 'у', 'ю', 'й', 'ь'
+], key=len, reverse=True)
+
+# Words that are not interests on their own, like "и" in "музеи и парки"
+STOP_WORDS = {
+    'и', 'или', 'а', 'но', 'да', 'в', 'во', 'на', 'с', 'со', 'по', 'к', 'ко', 'о', 'об', 'от', 'до',
+    'из', 'за', 'у', 'для', 'про', 'при', 'над', 'под', 'без', 'не', 'ни', 'же', 'ли', 'то', 'все', 'еще',
+}
+
+# Stems shorter than this are only matched exactly or by prefix, one changed
+# letter turns a short word into another word ("порт" and "спорт")
+FUZZY_MIN_STEM = 6
+
+# Normalized input -> suggestions, most recently used last
+memory_cache = OrderedDict()
+memory_loaded = False
+
+
+def stem(word):
+    "Strip common endings from the word"
+    # Two passes, so that "музей", "музеи" and "музеев" all become "муз"
+    for _ in range(2):
+        for ending in ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                word = word[:-len(ending)]
+                break
+    return word
+
+
+def interest_words(text):
+    """Meaningful words of interests text with their stems, [(stem, word)] in text
+    order, one per stem. One-letter and stop words are left out"""
+    words = re.sub(r"[^\w\s]", " ", (text or "").lower().replace('ё', 'е')).split()
+    result = []
+    stems = set()
+    for word in words:
+        if len(word) < 2 or word in STOP_WORDS:
+            continue
+        word_stem = stem(word)
+        if word_stem not in stems:
+            stems.add(word_stem)
+            result.append((word_stem, word))
+    return result
+
+
+def normalize_input(user_input):
+    """Turn interests input into a cache key: case, punctuation, word forms, order
+    and stop words do not matter"""
+    return " ".join(sorted(word_stem for word_stem, word in interest_words(user_input)))
+
+
+def one_edit_apart(a, b):
+    "True when the words differ in at most one inserted, deleted or replaced letter"
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+def stems_match(part, cached):
+    "Stem of the input matches a cached stem: the same, or a long one with a typo"
+    return part == cached or (min(len(part), len(cached)) >= FUZZY_MIN_STEM and one_edit_apart(part, cached))
+
+
+def remember(key, suggestions):
+    "Put suggestions into the in-memory cache"
+    memory_cache[key] = suggestions
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > INTERESTS_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+
+def load_interests_cache():
+    "Load the most recent cached suggestions from the database"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT input_key, suggestions FROM interests_cache
+        ORDER BY created_at DESC LIMIT ?
+    ''', (INTERESTS_CACHE_SIZE,))
+    return [(key, json.loads(suggestions)) for key, suggestions in reversed(cursor.fetchall())]
+
+
+def save_interests_suggestions(entries):
+    "Store (input_key, suggestions) pairs in the cache table"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.executemany('''
+        INSERT OR REPLACE INTO interests_cache (input_key, suggestions) VALUES (?, ?)
+    ''', [(key, json.dumps(suggestions, ensure_ascii=False)) for key, suggestions in entries])
+    conn.commit()
+
+
+def find_suggestions(key):
+    "Find cached suggestions by exact, prefix or per-stem fuzzy match of the normalized input"
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        return memory_cache[key]
+
+    # Unfinished input like "архит" still finds "архитектура". Every stem has to
+    # start a stem of the cached input, so "театры" does not find "театры, цирк"
+    if len(key) >= 4:
+        stems = key.split()
+        for cached_key in reversed(memory_cache):
+            cached_stems = cached_key.split()
+            if len(cached_stems) == len(stems) and all(
+                    cached.startswith(part) for part, cached in zip(stems, cached_stems)):
+                return memory_cache[cached_key]
+
+    # Typos are forgiven stem by stem and only in long stems
+    stems = key.split()
+    if any(len(part) >= FUZZY_MIN_STEM for part in stems):
+        for cached_key in reversed(memory_cache):
+            cached_stems = cached_key.split()
+            if len(cached_stems) == len(stems) and all(map(stems_match, stems, cached_stems)):
+                return memory_cache[cached_key]
+
+    return None
+
+
+def load_prompt_examples():
+    "Get (input, suggestions) examples from the interests prompt"
+    try:
+        with open(os.path.join(PROMPTS_DIR, 'interests_prompt'), 'r', encoding='utf-8') as f:
+            prompt = f.read()
+    except FileNotFoundError:
+        return []
+
+    examples = []
+    for user_input, suggestions in re.findall(r'ввел "(.+?)", предложи: (\[.*?\])', prompt):
+        try:
+            examples.append((user_input, json.loads(suggestions)))
+        except json.JSONDecodeError:
+            continue
+    return examples
+
+
+async def warm_interests_cache():
+    "Fill the in-memory cache from the database and the interests prompt examples"
+    global memory_loaded
+
+    for key, suggestions in await run_db(load_interests_cache):
+        # Keys stored before stop words were left out
+        key = " ".join(sorted(part for part in key.split() if len(part) >= 2 and part not in STOP_WORDS))
+        if key:
+            remember(key, suggestions)
+    memory_loaded = True
+
+    new_entries = []
+    for user_input, suggestions in load_prompt_examples():
+        key = normalize_input(user_input)
+        if key not in memory_cache:
+            remember(key, suggestions)
+            new_entries.append((key, suggestions))
+
+    if new_entries:
+        await run_db(save_interests_suggestions, new_entries)
+
+
+async def get_suggestions(user_input: str):
+    "Get interests suggestions from the cache or from DeepSeek"
+    if not memory_loaded:
+        await warm_interests_cache()
+
+    key = normalize_input(user_input)
+    if key:
+        suggestions = find_suggestions(key)
+        if suggestions:
+            return list(suggestions)
+
+    suggestions = await get_interests_suggestions(user_input)
+
+    # DeepSeek returns the input itself when it fails, do not cache that
+    if key and suggestions and suggestions != [user_input]:
+        remember(key, suggestions)
+        await run_db(save_interests_suggestions, [(key, suggestions)])
+
+    return suggestions
+
+
+# (input, cached input, should match) pairs checked by python -m bot.interests_cache
+MATCH_CHECKS = [
+    ("музеи и парки", "парки, музей", True),
+    ("архит", "архитектура", True),
+    ("архитектрура", "архитектура", True),
+    ("театры", "театры, цирк", False),
+    ("порт", "спорт", False),
+    ("арт", "карт", False),
+    ("рок", "урок", False),
+]
+
+
+def check_matching():
+    "Problems found by matching MATCH_CHECKS against a cache holding only the cached input"
+    problems = []
+    for user_input, cached_input, expected in MATCH_CHECKS:
+        memory_cache.clear()
+        remember(normalize_input(cached_input), [cached_input])
+        if (find_suggestions(normalize_input(user_input)) is not None) != expected:
+            problems.append(f'"{user_input}" {"does not match" if expected else "matches"} "{cached_input}"')
+    memory_cache.clear()
+    return problems
+
+
+if __name__ == "__main__":
+    # Cache matching check: python -m bot.interests_cache
+    problems = check_matching()
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    print(f"OK: {len(MATCH_CHECKS)} matching checks passed" if not problems else f"{len(problems)} problems found")
+    raise SystemExit(0 if not problems else 1)
@@ -16,7 +16,7 @@ def get_main_keyboard():
 def get_profile_keyboard():
     """Profile menu keyboard"""
     keyboard = [
-        [KeyboardButton(text="📊 Мои баллы")],
+        [KeyboardButton(text="📊 Мои баллы"), KeyboardButton(text="🏆 Рейтинг")],
         [KeyboardButton(text="📍 Мои маршруты")],
         [KeyboardButton(text="🛍️ Мои покупки")],
         [KeyboardButton(text="🔙 Назад")]
@@ -39,6 +39,7 @@ def get_route_settings_keyboard():
     keyboard = [
         [KeyboardButton(text="🔢 Изменить количество объектов")],
         [KeyboardButton(text="🔄 Пересоздать маршрут")],
+        [KeyboardButton(text="🔀 Любой порядок объектов")],
         [KeyboardButton(text="📍 Отправить местоположение", request_location=True)],
         [KeyboardButton(text="🔙 Назад")]
     ]
@@ -56,6 +57,15 @@ def get_shop_keyboard():
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
+def get_purchase_keyboard(items):
+    """Inline keyboard with a buy button for every shop item in stock"""
+    keyboard = [
+        [InlineKeyboardButton(text=f"Купить «{item[1]}» — {item[3]} баллов", callback_data=f"buy:{item[0]}")]
+        for item in items if item[7] is None or item[7] > 0
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
 def get_back_keyboard():
     """Back button keyboard"""
     keyboard = [[KeyboardButton(text="🔙 Назад")]]
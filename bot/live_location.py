@@ -0,0 +1,122 @@
+# bot/live_location.py
+import time
+
+from bot.config import (
+    POINTS_PER_OBJECT, LOCATION_ACCURACY,
+    LIVE_LOCATION_MIN_INTERVAL, LIVE_LOCATION_SESSION_TTL
+)
+from bot.database import get_route_state, record_visit, record_free_visits, run_db
+from bot.location_utils import fast_distance, match_route_stops
+
+# Route state is re-read from the database at least this often (in seconds)
+ROUTE_STATE_TTL = 60
+
+# Expired sessions are looked for once per this many updates
+CLEANUP_EVERY = 1000
+
+
+class LiveSession:
+    "Live location state of one user"
+    __slots__ = ('last_seen', 'last_lat', 'last_lon', 'slack', 'route_state', 'loaded_at', 'busy')
+
+    def __init__(self):
+        self.last_seen = 0.0
+        # Position of the last geofence check and how far the user can move from
+        # it without reaching any target (in meters)
+        self.last_lat = None
+        self.last_lon = None
+        self.slack = 0.0
+        self.route_state = None
+        self.loaded_at = 0.0
+        self.busy = False
+
+
+# tg_id -> LiveSession
+sessions = {}
+updates_count = 0
+
+
+def reset_live_session(tg_id):
+    "Forget cached route state of the user (call when the route changes)"
+    sessions.pop(tg_id, None)
+
+
+def reset_live_sessions():
+    "Forget cached route states of all users"
+    sessions.clear()
+
+
+def cleanup_sessions(now):
+    "Drop sessions without recent updates"
+    for tg_id in [tg_id for tg_id, session in sessions.items()
+                  if now - session.last_seen > LIVE_LOCATION_SESSION_TTL]:
+        del sessions[tg_id]
+
+
+async def check_live_location(tg_id, lat, lon):
+    """Check live location update of the user against the current route.
+    Returns (route, recorded positions, route finished) when objects were visited,
+    otherwise None. Updates are throttled per user and the geofence is only
+    checked again when the user has moved far enough to possibly reach a target"""
+    global updates_count
+
+    now = time.monotonic()
+    updates_count += 1
+    if updates_count % CLEANUP_EVERY == 0:
+        cleanup_sessions(now)
+
+    session = sessions.get(tg_id)
+    if session is None:
+        session = sessions[tg_id] = LiveSession()
+
+    # Skip updates arriving too often or while the previous one is processed
+    if session.busy or now - session.last_seen < LIVE_LOCATION_MIN_INTERVAL:
+        return None
+    session.last_seen = now
+
+    if session.last_lat is not None and now - session.loaded_at < ROUTE_STATE_TTL:
+        if fast_distance(session.last_lat, session.last_lon, lat, lon) <= session.slack:
+            return None
+
+    session.busy = True
+    try:
+        if session.route_state is None or now - session.loaded_at >= ROUTE_STATE_TTL:
+            session.route_state = await run_db(get_route_state, tg_id)
+            session.loaded_at = now
+
+        if not session.route_state:
+            return None
+
+        route_id, route, step, free_order, visited = session.route_state
+        if free_order:
+            targets = [position for position in range(len(route)) if position not in visited]
+        else:
+            targets = [step] if step < len(route) else []
+
+        if not targets:
+            # Nothing left to visit, do not check until the route state is reloaded
+            session.last_lat, session.last_lon, session.slack = lat, lon, float('inf')
+            return None
+
+        matched, nearest, distance = match_route_stops(lat, lon, route_id, route, targets)
+        if not matched:
+            session.last_lat, session.last_lon = lat, lon
+            session.slack = max(distance - LOCATION_ACCURACY, 0.0)
+            return None
+
+        if free_order:
+            recorded = await run_db(record_free_visits, tg_id, route_id, matched, POINTS_PER_OBJECT)
+        else:
+            recorded = [step] if await run_db(record_visit, tg_id, step, route[step], POINTS_PER_OBJECT) else []
+
+        # Route state has changed, read it again on the next update
+        session.route_state = None
+        session.last_lat = session.last_lon = None
+
+        if not recorded:
+            return None
+
+        finished = len(visited) + len(recorded) >= len(route) if free_order else step + 1 >= len(route)
+        return route, recorded, finished
+    finally:
+        session.busy = False
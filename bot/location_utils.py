@@ -1,19 +1,178 @@
 # bot/location_utils.py
+import math
+from collections import OrderedDict
+import numpy as np
 from geopy.distance import geodesic
 from bot.config import LOCATION_ACCURACY
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate distance between two points in meters"""
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+# The fast distance projects both points on a plane using the ellipsoid radii of
+# curvature at their middle latitude. For points up to FAST_DISTANCE_RANGE meters
+# apart (below 70° latitude) it differs from geodesic by less than
+# FAST_DISTANCE_ERROR of the distance (under 0.1 mm at 50 m), farther the error
+# grows with the square of the distance (about 0.01% at 100 km)
+FAST_DISTANCE_RANGE = 10000
+FAST_DISTANCE_ERROR = 1e-5
+
+# Routes with more stops than this are searched through a grid index
+GRID_INDEX_MIN_STOPS = 64
+
+# Size of a grid index cell in degrees (about 1.1 km x 0.65 km in Minsk), so only
+# neighbouring cells have to be checked for accuracy up to GRID_MAX_ACCURACY meters
+GRID_CELL_SIZE = 0.01
+GRID_MAX_ACCURACY = 500
+
+# Grid indexes of recently checked routes: route_id -> {cell: [positions]}
+route_grids = OrderedDict()
+ROUTE_GRIDS_SIZE = 256
+
+
+def geodesic_distance(lat1, lon1, lat2, lon2):
+    """Calculate exact distance between two points on the WGS84 ellipsoid in meters"""
     point1 = (lat1, lon1)
     point2 = (lat2, lon2)
     distance_km = geodesic(point1, point2).kilometers
     return distance_km * 1000  # Convert to meters
 
+
+def fast_distance(lat1, lon1, lat2, lon2):
+    """Calculate approximate distance between two close points in meters"""
+    phi = math.radians((lat1 + lat2) / 2)
+    w = 1 - WGS84_E2 * math.sin(phi) ** 2
+    meridian_radius = WGS84_A * (1 - WGS84_E2) / (w * math.sqrt(w))
+    normal_radius = WGS84_A / math.sqrt(w)
+
+    y = math.radians(lat2 - lat1) * meridian_radius
+    x = math.radians(lon2 - lon1) * normal_radius * math.cos(phi)
+    return math.hypot(x, y)
+
+
+def fast_distances(lat, lon, lats, lons):
+    """Calculate approximate distances in meters from one point to many points at once"""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    phi = np.radians((lats + lat) / 2)
+    w = 1 - WGS84_E2 * np.sin(phi) ** 2
+    meridian_radius = WGS84_A * (1 - WGS84_E2) / (w * np.sqrt(w))
+    normal_radius = WGS84_A / np.sqrt(w)
+
+    y = np.radians(lats - lat) * meridian_radius
+    x = np.radians(lons - lon) * normal_radius * np.cos(phi)
+    return np.hypot(x, y)
+
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """Calculate distance between two points in meters"""
+    distance = fast_distance(lat1, lon1, lat2, lon2)
+    if distance > FAST_DISTANCE_RANGE:
+        return geodesic_distance(lat1, lon1, lat2, lon2)
+    return distance
+
+
+def is_near_accuracy(distance, accuracy):
+    """Check if the fast distance is too close to the accuracy border to be trusted"""
+    return abs(distance - accuracy) <= accuracy * FAST_DISTANCE_ERROR or accuracy > FAST_DISTANCE_RANGE
+
+
 def is_location_match(user_lat, user_lon, target_lat, target_lon, accuracy=LOCATION_ACCURACY):
     """Check if user location matches target location within accuracy"""
-    distance = calculate_distance(user_lat, user_lon, target_lat, target_lon)
+    distance = fast_distance(user_lat, user_lon, target_lat, target_lon)
+    if is_near_accuracy(distance, accuracy):
+        distance = geodesic_distance(user_lat, user_lon, target_lat, target_lon)
     return distance <= accuracy
 
+
+def match_locations(user_lat, user_lon, lats, lons, accuracy=LOCATION_ACCURACY):
+    """Check which of many target locations match user location within accuracy.
+    Returns distances in meters and a boolean array of matches"""
+    distances = fast_distances(user_lat, user_lon, lats, lons)
+    for i in np.flatnonzero(np.abs(distances - accuracy) <= accuracy * FAST_DISTANCE_ERROR):
+        distances[i] = geodesic_distance(user_lat, user_lon, lats[i], lons[i])
+    return distances, distances <= accuracy
+
+
+def get_route_grid(route_id, route):
+    """Get grid index of route stops, built once per route"""
+    grid = route_grids.get(route_id)
+    if grid is None:
+        grid = {}
+        for position, obj in enumerate(route):
+            cell = (math.floor(obj['latitude'] / GRID_CELL_SIZE), math.floor(obj['longitude'] / GRID_CELL_SIZE))
+            grid.setdefault(cell, []).append(position)
+        route_grids[route_id] = grid
+        while len(route_grids) > ROUTE_GRIDS_SIZE:
+            route_grids.popitem(last=False)
+    route_grids.move_to_end(route_id)
+    return grid
+
+
+def match_route_stops(user_lat, user_lon, route_id, route, positions, accuracy=LOCATION_ACCURACY):
+    """Match user location against route stops at the given positions in one pass.
+    Returns positions of matched stops, and position of the nearest stop
+    with distance to it (only when nothing matched)"""
+    positions = list(positions)
+    if not positions:
+        return [], None, None
+
+    if len(route) > GRID_INDEX_MIN_STOPS and accuracy <= GRID_MAX_ACCURACY:
+        # Only stops in the user's and neighbouring cells can be close enough
+        grid = get_route_grid(route_id, route)
+        cell_lat = math.floor(user_lat / GRID_CELL_SIZE)
+        cell_lon = math.floor(user_lon / GRID_CELL_SIZE)
+        wanted = set(positions)
+        candidates = [position
+                      for d_lat in (-1, 0, 1) for d_lon in (-1, 0, 1)
+                      for position in grid.get((cell_lat + d_lat, cell_lon + d_lon), [])
+                      if position in wanted]
+    else:
+        candidates = positions
+
+    if candidates:
+        lats = [route[position]['latitude'] for position in candidates]
+        lons = [route[position]['longitude'] for position in candidates]
+        distances, matched = match_locations(user_lat, user_lon, lats, lons, accuracy)
+        if matched.any():
+            return [candidates[i] for i in np.flatnonzero(matched)], None, None
+
+    # Nothing matched, find the nearest stop among all of them for the user
+    lats = [route[position]['latitude'] for position in positions]
+    lons = [route[position]['longitude'] for position in positions]
+    distances = fast_distances(user_lat, user_lon, lats, lons)
+    nearest = int(np.argmin(distances))
+    return [], positions[nearest], float(distances[nearest])
+
+
 def format_coordinates(lat, lon):
     """Format coordinates for display"""
-    return f"широта: {lat:.6f}, долгота: {lon:.6f}"
\ No newline at end of file
+    return f"широта: {lat:.6f}, долгота: {lon:.6f}"
+
+
+if __name__ == "__main__":
+    # Benchmark: python -m bot.location_utils
+    import random
+    import timeit
+
+    random.seed(1)
+    lats = [53.85 + random.random() * 0.1 for _ in range(20)]
+    lons = [27.45 + random.random() * 0.2 for _ in range(20)]
+    user_lat, user_lon = 53.9045, 27.5577
+
+    runs = 2000
+    seconds = timeit.timeit(lambda: geodesic_distance(user_lat, user_lon, lats[0], lons[0]), number=runs)
+    print(f"geodesic, one point: {seconds / runs * 1e6:.2f} us")
+    seconds = timeit.timeit(lambda: fast_distance(user_lat, user_lon, lats[0], lons[0]), number=runs)
+    print(f"fast, one point: {seconds / runs * 1e6:.2f} us")
+    seconds = timeit.timeit(lambda: [geodesic_distance(user_lat, user_lon, lat, lon)
+                                     for lat, lon in zip(lats, lons)], number=runs // 10)
+    print(f"geodesic, 20 points: {seconds / (runs // 10) * 1e6:.2f} us")
+    seconds = timeit.timeit(lambda: fast_distances(user_lat, user_lon, lats, lons), number=runs)
+    print(f"fast batched, 20 points: {seconds / runs * 1e6:.2f} us")
+
+    error = max(abs(fast_distance(user_lat, user_lon, lat, lon) - geodesic_distance(user_lat, user_lon, lat, lon))
+                for lat, lon in zip(lats, lons))
+    print(f"max difference on these points: {error * 1000:.4f} mm")
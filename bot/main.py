@@ -1,25 +1,158 @@
 # bot/main.py
 import asyncio
 import logging
+from aiohttp import web
 from aiogram import Bot, Dispatcher
-from bot.config import TELEGRAM_BOT_TOKEN
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from bot.config import (
+    TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL, BOT_MODE,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_IN_BACKGROUND, SHUTDOWN_TIMEOUT, CLUSTER_WORKER,
+    SCHEDULER_MAX_PENDING, SCHEDULER_STATS_INTERVAL, FSM_STORAGE
+)
+from bot.database import init_database, clear_user_cache
+from bot.deepseek_integration import api_metrics, log_api_stats
+from bot.fsm_storage import SQLiteStorage
 from bot.handlers import router
+from bot.live_location import reset_live_sessions
+from bot.scheduler import UpdateScheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
-async def main():
-    # Initialize bot and dispatcher
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    dp = Dispatcher()
+
+class UpdatesInFlight:
+    "Outer middleware counting updates being processed, so shutdown can wait for them"
+
+    def __init__(self):
+        self.count = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self.idle.set()
+
+    async def wait(self, timeout):
+        "Wait until no update is processed, at most timeout seconds"
+        # Let updates accepted just before shutdown start processing
+        await asyncio.sleep(0)
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Shutdown with %d updates still being processed", self.count)
+
+
+def create_bot():
+    "Create bot, talking to TELEGRAM_API_URL if it is set"
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    return Bot(token=TELEGRAM_BOT_TOKEN, session=session)
+
+
+def create_dispatcher():
+    "Create dispatcher with the bot handlers"
+    # Dialog states in the database are shared by bot processes, otherwise kept in memory
+    dp = Dispatcher(storage=SQLiteStorage() if FSM_STORAGE == 'sqlite' else None)
 
     # Include routers
     dp.include_router(router)
 
-    # Start polling
-    await dp.start_polling(bot)
+    in_flight = UpdatesInFlight()
+    dp.update.outer_middleware(in_flight)
+    # Updates of one user in order, of different users concurrently
+    scheduler = UpdateScheduler()
+    dp.update.outer_middleware(scheduler)
+    dp['scheduler'] = scheduler
+    stats_tasks = []
+
+    async def on_startup(bot: Bot):
+        if SCHEDULER_STATS_INTERVAL > 0:
+            stats_tasks.append(asyncio.create_task(scheduler.log_stats()))
+            stats_tasks.append(asyncio.create_task(log_api_stats(SCHEDULER_STATS_INTERVAL)))
+        if BOT_MODE == 'webhook' and WEBHOOK_URL:
+            await set_webhook(bot, dp)
+
+    async def on_shutdown():
+        await in_flight.wait(SHUTDOWN_TIMEOUT)
+        for task in stats_tasks:
+            task.cancel()
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def set_webhook(bot, dp):
+    "Ask Telegram to push updates to WEBHOOK_URL"
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                          allowed_updates=dp.resolve_used_update_types())
+
+
+async def run_polling(bot, dp):
+    "Receive updates by long polling"
+    # Telegram does not give updates by polling while a webhook is set
+    await bot.delete_webhook()
+    # Fetching pauses while the scheduler is full, the rest stays with Telegram
+    await dp.start_polling(bot, tasks_concurrency_limit=SCHEDULER_MAX_PENDING)
+
+
+def run_webhook(bot, dp):
+    """Receive updates pushed by Telegram to an aiohttp server. Each update is
+    processed in its own task, SIGINT / SIGTERM stop accepting new updates and
+    wait for the ones being processed"""
+    app = web.Application()
+
+    # Shutdown callbacks run in the order they are added: the dispatcher shutdown
+    # (waiting for updates) has to come before the request handler closes the bot session
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=WEBHOOK_IN_BACKGROUND
+    ).register(app, path=WEBHOOK_PATH)
+
+    async def health(request):
+        "Liveness check used by bot.cluster, with the scheduler queue depth and DeepSeek metrics"
+        return web.json_response({**dp['scheduler'].stats(), 'deepseek': api_metrics()})
+
+    async def reset_caches(request):
+        "Drop cached user data, used by bot.cluster when users come back from another process"
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        clear_user_cache()
+        reset_live_sessions()
+        return web.json_response({'ok': True})
+
+    # Internal metrics and cache control are only reachable by the local launcher
+    if CLUSTER_WORKER and WEBHOOK_HOST == '127.0.0.1':
+        app.router.add_get('/health', health)
+        app.router.add_post('/reset-caches', reset_caches)
+
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+
+def main():
+    # Create missing tables and migrate old data
+    init_database()
+
+    # Initialize bot and dispatcher
+    bot = create_bot()
+    dp = create_dispatcher()
+
+    if BOT_MODE == 'webhook':
+        run_webhook(bot, dp)
+    else:
+        asyncio.run(run_polling(bot, dp))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -0,0 +1,182 @@
+# bot/poi_catalog.py
+import csv
+import json
+import math
+import random
+import sys
+
+from bot.database import get_connection, init_database
+from bot.interests_cache import interest_words
+from bot.location_utils import calculate_distance
+
+# Size of a spatial grid cell in degrees (about 1.1 km x 0.65 km in Minsk)
+CELL_SIZE = 0.01
+
+# Catalog routes keep to points within this distance of their best match when
+# there are enough of them, so the route can be walked (in meters)
+ROUTE_RADIUS = 3000
+
+# OSM style properties whose values are used as tags
+TAG_PROPERTIES = ('tourism', 'historic', 'leisure', 'amenity', 'building', 'category')
+
+
+def get_cell(lat, lon):
+    "Get grid cell of the point"
+    return math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+
+
+def split_tags(tags):
+    "Turn tags given as a list or a ';' / ',' separated string into a list"
+    if not tags:
+        return []
+    if isinstance(tags, str):
+        tags = tags.replace(';', ',').split(',')
+    return [tag.strip() for tag in tags if tag and tag.strip()]
+
+
+def add_poi(cursor, name, description, lat, lon, tags):
+    "Insert or update a point of interest and index its tags"
+    cell_lat, cell_lon = get_cell(lat, lon)
+
+    cursor.execute('''
+        INSERT INTO pois (name, description, latitude, longitude, tags, cell_lat, cell_lon)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (name, latitude, longitude) DO UPDATE
+        SET description = excluded.description, tags = excluded.tags
+    ''', (name, description, lat, lon, ", ".join(tags), cell_lat, cell_lon))
+    cursor.execute("SELECT id FROM pois WHERE name = ? AND latitude = ? AND longitude = ?", (name, lat, lon))
+    poi_id = cursor.fetchone()[0]
+
+    # Tags and words of the name are searchable by the same stems as user interests
+    stems = {word_stem for word_stem, word in interest_words(" ".join(tags + [name]))}
+    cursor.execute("DELETE FROM poi_tags WHERE poi_id = ?", (poi_id,))
+    cursor.executemany("INSERT INTO poi_tags (tag, poi_id) VALUES (?, ?)",
+                       [(stem, poi_id) for stem in stems])
+
+
+def import_geojson(path):
+    "Import points of interest from a GeoJSON FeatureCollection, returns number of imported points"
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    count = 0
+
+    for feature in data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        properties = feature.get('properties') or {}
+        name = properties.get('name')
+        if geometry.get('type') != 'Point' or not name:
+            continue
+
+        lon, lat = geometry['coordinates'][:2]
+        tags = split_tags(properties.get('tags'))
+        tags += [str(properties[key]) for key in TAG_PROPERTIES if properties.get(key)]
+
+        add_poi(cursor, name, properties.get('description', ''), lat, lon, tags)
+        count += 1
+
+    conn.commit()
+    return count
+
+
+def import_csv(path):
+    """Import points of interest from CSV with name, description, latitude, longitude
+    and tags columns, returns number of imported points"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    count = 0
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            if not row.get('name'):
+                continue
+            add_poi(cursor, row['name'], row.get('description', ''), float(row['latitude']),
+                    float(row['longitude']), split_tags(row.get('tags')))
+            count += 1
+
+    conn.commit()
+    return count
+
+
+def find_pois_near(lat, lon, radius):
+    "Get points of interest within radius (in meters) of the point, nearest first"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    # Grid cells covering the circle
+    lat_delta = radius / 111320
+    lon_delta = radius / (111320 * max(math.cos(math.radians(lat)), 0.01))
+    min_cell_lat, min_cell_lon = get_cell(lat - lat_delta, lon - lon_delta)
+    max_cell_lat, max_cell_lon = get_cell(lat + lat_delta, lon + lon_delta)
+
+    cursor.execute('''
+        SELECT id, name, description, latitude, longitude FROM pois
+        WHERE cell_lat BETWEEN ? AND ? AND cell_lon BETWEEN ? AND ?
+    ''', (min_cell_lat, max_cell_lat, min_cell_lon, max_cell_lon))
+
+    pois = []
+    for poi_id, name, description, poi_lat, poi_lon in cursor.fetchall():
+        distance = calculate_distance(lat, lon, poi_lat, poi_lon)
+        if distance <= radius:
+            pois.append((distance, {"id": poi_id, "name": name, "description": description,
+                                    "latitude": poi_lat, "longitude": poi_lon}))
+
+    pois.sort(key=lambda item: item[0])
+    return [poi for distance, poi in pois]
+
+
+def build_catalog_route(interests, count, shuffle=False):
+    """Build route from catalog points of interest matching the interests.
+    The best matching points are taken, with shuffle=True a random choice among
+    good matches is made instead. Points near the best match (found with the grid
+    index) are preferred. Returns empty list if the catalog has not enough
+    matching points"""
+    stems = [word_stem for word_stem, word in interest_words(interests)]
+    if not stems:
+        return []
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    placeholders = ", ".join("?" * len(stems))
+    cursor.execute(f'''
+        SELECT p.id, p.name, p.description, p.latitude, p.longitude, COUNT(*) AS score
+        FROM poi_tags t JOIN pois p ON p.id = t.poi_id
+        WHERE t.tag IN ({placeholders})
+        GROUP BY p.id
+        ORDER BY score DESC, p.id
+        LIMIT ?
+    ''', (*stems, count * 10))
+    rows = cursor.fetchall()
+
+    if len(rows) < count:
+        return []
+
+    # Matches within walking distance of the best one (a random good one with shuffle)
+    anchor = random.choice(rows[:count]) if shuffle else rows[0]
+    near = {poi["id"] for poi in find_pois_near(anchor[3], anchor[4], ROUTE_RADIUS)}
+    close = [row for row in rows if row[0] in near]
+    if len(close) >= count:
+        rows = close
+    rows = rows[:count * 3 if shuffle else count]
+
+    if shuffle:
+        # Keep the best matches first
+        rows = [rows[i] for i in sorted(random.sample(range(len(rows)), count))]
+
+    return [{"name": name, "description": description or "", "latitude": lat, "longitude": lon}
+            for poi_id, name, description, lat, lon, score in rows]
+
+
+if __name__ == "__main__":
+    # python -m bot.poi_catalog pois.geojson|pois.csv
+    if len(sys.argv) != 2:
+        print("Usage: python -m bot.poi_catalog <file.geojson|file.csv>")
+        sys.exit(1)
+
+    init_database()
+    path = sys.argv[1]
+    imported = import_csv(path) if path.lower().endswith('.csv') else import_geojson(path)
+    print(f"Imported {imported} points of interest")
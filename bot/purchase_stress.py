@@ -0,0 +1,139 @@
+# bot/purchase_stress.py
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from bot import database
+from bot.database import (
+    get_connection, init_database, purchase_item,
+    PURCHASE_OK, PURCHASE_DUPLICATE
+)
+
+USERS = 50
+START_POINTS = 1000
+UNLIMITED_PRICE = 70
+LIMITED_PRICE = 30
+LIMITED_STOCK = 100
+
+
+def use_database(path):
+    "Point the database module of this process at the test database"
+    database.close_connection()
+    database.DATABASE_PATH = path
+
+
+def prepare_database(path):
+    "Create test users and two shop items, returns ids of the items"
+    use_database(path)
+    init_database()
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.executemany("INSERT INTO users (tg_id, points) VALUES (?, ?)",
+                       [(tg_id, START_POINTS) for tg_id in range(1, USERS + 1)])
+    cursor.execute("INSERT INTO shop_items (name, price, stock) VALUES ('unlimited', ?, NULL)",
+                   (UNLIMITED_PRICE,))
+    unlimited_id = cursor.lastrowid
+    cursor.execute("INSERT INTO shop_items (name, price, stock) VALUES ('limited', ?, ?)",
+                   (LIMITED_PRICE, LIMITED_STOCK))
+    limited_id = cursor.lastrowid
+    conn.commit()
+    return unlimited_id, limited_id
+
+
+def buy_many(item_ids, count, seed):
+    "Make count random purchases, returns Counter of results"
+    rng = random.Random(seed)
+    results = Counter()
+    for _ in range(count):
+        tg_id = rng.randint(1, USERS)
+        item_id = rng.choice(item_ids)
+        # Few keys per user and item, so many calls are repeated taps
+        key = f"{tg_id}:{item_id}:{rng.randint(1, 40)}"
+        status, name, points = purchase_item(tg_id, item_id, key)
+        results[status] += 1
+    return results
+
+
+def run_worker(path, item_ids, threads, count, seed):
+    "Buy from several threads of one process, each with its own connection"
+    use_database(path)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(buy_many, item_ids, count, seed * 1000 + i) for i in range(threads)]
+        return sum((future.result() for future in futures), Counter())
+
+
+def check_database(unlimited_id, limited_id, ok_count):
+    "Check that points, stock and purchases add up. Returns list of problems"
+    conn = get_connection()
+    cursor = conn.cursor()
+    problems = []
+
+    cursor.execute("SELECT COUNT(*) FROM users WHERE points < 0")
+    if cursor.fetchone()[0]:
+        problems.append("users with negative points")
+
+    cursor.execute('''
+        SELECT u.tg_id, u.points, COALESCE(SUM(p.price), 0)
+        FROM users u LEFT JOIN purchases p ON p.tg_id = u.tg_id
+        GROUP BY u.tg_id
+    ''')
+    for tg_id, points, spent in cursor.fetchall():
+        if points != START_POINTS - spent:
+            problems.append(f"user {tg_id}: {points} points, spent {spent} of {START_POINTS}")
+
+    cursor.execute("SELECT stock FROM shop_items WHERE id = ?", (limited_id,))
+    stock = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM purchases WHERE item_id = ?", (limited_id,))
+    sold = cursor.fetchone()[0]
+    if stock < 0 or stock + sold != LIMITED_STOCK:
+        problems.append(f"limited item: {sold} sold, {stock} left of {LIMITED_STOCK}")
+
+    cursor.execute("SELECT COUNT(*) FROM purchases")
+    purchases = cursor.fetchone()[0]
+    if purchases != ok_count:
+        problems.append(f"{purchases} purchases recorded, {ok_count} reported as bought")
+
+    return problems
+
+
+def main(processes, threads, count):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stress.db')
+        item_ids = prepare_database(path)
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(run_worker, path, item_ids, threads, count, seed)
+                       for seed in range(processes)]
+            results = sum((future.result() for future in futures), Counter())
+        elapsed = time.perf_counter() - started
+
+        total = sum(results.values())
+        print(f"{total} purchases from {processes} processes x {threads} threads "
+              f"in {elapsed:.1f} s ({total / elapsed:.0f}/s)")
+        for status, number in results.most_common():
+            print(f"  {status}: {number}")
+
+        problems = check_database(*item_ids, results[PURCHASE_OK])
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        if not results[PURCHASE_DUPLICATE]:
+            print("WARNING: no repeated taps were made, increase --count")
+        print("OK: no overspending" if not problems else f"{len(problems)} problems found")
+        return not problems
+
+
+if __name__ == "__main__":
+    # Concurrency check of purchases: python -m bot.purchase_stress
+    parser = argparse.ArgumentParser(description="Fire parallel purchases and check nothing is overspent")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="threads per process")
+    parser.add_argument("--count", type=int, default=100, help="purchases per thread")
+    args = parser.parse_args()
+
+    raise SystemExit(0 if main(args.processes, args.threads, args.count) else 1)
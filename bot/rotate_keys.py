@@ -0,0 +1,141 @@
+# bot/rotate_keys.py
+import argparse
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from bot.crypto_utils import KEY_FINGERPRINT, OLD_ENCRYPTION_KEYS, rotate_data, rotate_users_chunk
+from bot.database import get_connection, init_database
+
+
+def read_users_batch(cursor, last_id, batch_size):
+    "Read next batch of (id, name, phone) rows after last_id"
+    cursor.execute('''
+        SELECT id, name, phone FROM users WHERE id > ? ORDER BY id LIMIT ?
+    ''', (last_id, batch_size))
+    return cursor.fetchall()
+
+
+def write_rotated_batch(conn, rows):
+    """Store re-encrypted rows and progress in one short transaction.
+    Returns number of updated users"""
+    cursor = conn.cursor()
+    updated = 0
+
+    for user_id, old_name, old_phone, name, phone, phone_index in rows:
+        # Rows changed by the bot since they were read already use the current key
+        cursor.execute('''
+            UPDATE users SET name = ?, phone = ?, phone_index = ?
+            WHERE id = ? AND name IS ? AND phone IS ?
+        ''', (name, phone, phone_index, user_id, old_name, old_phone))
+        updated += cursor.rowcount
+
+    cursor.execute('''
+        UPDATE key_rotation SET last_user_id = ?, rotated_users = rotated_users + ?
+        WHERE key_fingerprint = ?
+    ''', (rows[-1][0], updated, KEY_FINGERPRINT))
+    conn.commit()
+    return updated
+
+
+def rotate_fsm_storage(conn, batch_size):
+    "Re-encrypt dialog data (bot.fsm_storage) with the current key, returns number of rows"
+    cursor = conn.cursor()
+    rotated = 0
+    last_key = ''
+
+    while True:
+        cursor.execute('''
+            SELECT key, data FROM fsm_storage WHERE key > ? AND data IS NOT NULL ORDER BY key LIMIT ?
+        ''', (last_key, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return rotated
+        last_key = rows[-1][0]
+
+        for key, data in rows:
+            # Data changed by the bot since it was read already uses the current key
+            cursor.execute("UPDATE fsm_storage SET data = ? WHERE key = ? AND data = ?",
+                           (rotate_data(data), key, data))
+            rotated += cursor.rowcount
+        conn.commit()
+
+
+def rotate_encryption(batch_size=500, workers=None):
+    """Re-encrypt names and phones of all users and dialog data with the current key.
+    Users are read in id order in small batches that are re-encrypted by a process
+    pool and written in separate short transactions, so the bot keeps working.
+    Progress is stored, an interrupted rotation continues where it stopped"""
+    init_database()
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute("INSERT OR IGNORE INTO key_rotation (key_fingerprint) VALUES (?)", (KEY_FINGERPRINT,))
+    conn.commit()
+    cursor.execute("SELECT last_user_id, finished FROM key_rotation WHERE key_fingerprint = ?",
+                   (KEY_FINGERPRINT,))
+    last_id, finished = cursor.fetchone()
+
+    if finished:
+        print("All users are already encrypted with the current key")
+        return
+
+    if last_id:
+        print(f"Continuing rotation after user id {last_id}")
+
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    rotated = 0
+
+    if workers < 2:
+        while True:
+            rows = read_users_batch(cursor, last_id, batch_size)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            rotated += write_rotated_batch(conn, rotate_users_chunk(rows))
+            print(f"{rotated} users, {rotated / (time.perf_counter() - started):.0f} users/s")
+    else:
+        # Started fresh instead of forked, like the pool of crypto_utils.decrypt_bulk
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # Keep a few batches in flight and write them back in id order
+            in_flight = deque()
+            while True:
+                while len(in_flight) < workers * 2:
+                    rows = read_users_batch(cursor, last_id, batch_size)
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    in_flight.append(pool.submit(rotate_users_chunk, rows))
+
+                if not in_flight:
+                    break
+
+                rotated += write_rotated_batch(conn, in_flight.popleft().result())
+                print(f"{rotated} users, {rotated / (time.perf_counter() - started):.0f} users/s")
+
+    dialogs = rotate_fsm_storage(conn, batch_size)
+
+    cursor.execute("UPDATE key_rotation SET finished = 1 WHERE key_fingerprint = ?", (KEY_FINGERPRINT,))
+    conn.commit()
+
+    elapsed = time.perf_counter() - started
+    print(f"Rotation finished: {rotated} users and {dialogs} dialog states in {elapsed:.1f} s")
+    if OLD_ENCRYPTION_KEYS:
+        print("OLD_ENCRYPTION_KEYS can now be removed from the configuration")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encrypt user data with the current ENCRYPTION_KEY")
+    parser.add_argument("--batch-size", type=int, default=500, help="users per transaction")
+    parser.add_argument("--workers", type=int, default=None, help="encryption processes (default: CPU count)")
+    args = parser.parse_args()
+
+    try:
+        rotate_encryption(args.batch_size, args.workers)
+    except ValueError as e:
+        # Progress is kept, the rotation continues from here when started again
+        print(f"Rotation stopped: {e}")
+        raise SystemExit(1)
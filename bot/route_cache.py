@@ -0,0 +1,96 @@
+# bot/route_cache.py
+import json
+import random
+import re
+import time
+from collections import OrderedDict
+
+from bot.config import ROUTE_CACHE_TTL, ROUTE_CACHE_SIZE
+from bot.database import get_connection, run_db
+from bot.deepseek_integration import get_route_from_deepseek, FALLBACK_ROUTE
+
+# In-memory LRU in front of the route_cache table: (interests_key, count) -> (created_at, route)
+memory_cache = OrderedDict()
+
+
+def normalize_interests(interests):
+    "Turn interests text into a canonical cache key (order, case and spacing do not matter)"
+    parts = re.split(r"[,;\n]+", interests.lower().replace("ё", "е"))
+    words = {" ".join(part.split()) for part in parts}
+    words.discard("")
+    return ",".join(sorted(words))
+
+
+def remember(key, created_at, route):
+    "Put route into the in-memory LRU"
+    memory_cache[key] = (created_at, route)
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > ROUTE_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+
+def load_cached_route(interests_key, count):
+    """Find a fresh cached route for the interests with at least count objects.
+    Returns (created_at, route) or None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT created_at, route FROM route_cache
+        WHERE interests_key = ? AND count >= ? AND created_at > ?
+        ORDER BY count LIMIT 1
+    ''', (interests_key, count, time.time() - ROUTE_CACHE_TTL))
+    row = cursor.fetchone()
+
+    if row:
+        return row[0], json.loads(row[1])
+
+    return None
+
+
+def save_cached_route(interests_key, count, route, created_at):
+    "Store route in the cache table and drop expired routes"
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO route_cache (interests_key, count, route, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (interests_key, count, json.dumps(route), created_at))
+    cursor.execute("DELETE FROM route_cache WHERE created_at <= ?", (created_at - ROUTE_CACHE_TTL,))
+    conn.commit()
+
+
+async def get_route(interests: str, count: int, fresh=False):
+    """Get route for the interests from the cache or generate it with DeepSeek.
+    A cached route with more objects is served as a random subset of count objects.
+    With fresh=True the cache is not read, but the new route is still stored"""
+    interests_key = normalize_interests(interests)
+    key = (interests_key, count)
+
+    if not fresh:
+        cached = memory_cache.get(key)
+        if cached and cached[0] > time.time() - ROUTE_CACHE_TTL:
+            memory_cache.move_to_end(key)
+            return list(cached[1])
+
+        cached = await run_db(load_cached_route, interests_key, count)
+        if cached:
+            created_at, route = cached
+            if len(route) > count:
+                # Keep the original order of the chosen objects
+                chosen = sorted(random.sample(range(len(route)), count))
+                route = [route[i] for i in chosen]
+            else:
+                remember(key, created_at, route)
+            return list(route)
+
+    route = await get_route_from_deepseek(interests, count)
+
+    # Do not cache failures
+    if route and route != FALLBACK_ROUTE:
+        created_at = time.time()
+        remember(key, created_at, route)
+        await run_db(save_cached_route, interests_key, count, route, created_at)
+
+    return route
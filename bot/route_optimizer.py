@@ -0,0 +1,157 @@
+# bot/route_optimizer.py
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # meters
+
+
+def distance_matrix(lats, lons):
+    "Haversine distances (in meters) between all pairs of points"
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def nearest_neighbour_path(dist):
+    "Path starting at node 0 that always goes to the nearest unvisited node"
+    n = len(dist)
+    path = [0]
+    unvisited = set(range(1, n))
+    while unvisited:
+        row = dist[path[-1]]
+        nearest = min(unvisited, key=row.__getitem__)
+        path.append(nearest)
+        unvisited.remove(nearest)
+    return path
+
+
+def path_length(path, dist):
+    "Total length of an open path"
+    return sum(dist[a][b] for a, b in zip(path, path[1:]))
+
+
+def two_opt(path, dist):
+    "Improve open path by reversing segments while it gets shorter (node 0 stays first)"
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = path[i - 1], path[i]
+            for j in range(i + 1, n):
+                c = path[j]
+                delta = dist[a][c] - dist[a][b]
+                if j + 1 < n:
+                    e = path[j + 1]
+                    delta += dist[b][e] - dist[c][e]
+                if delta < -1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    a, b = path[i - 1], path[i]
+                    improved = True
+    return path
+
+
+def or_opt(path, dist):
+    "Improve open path by moving segments of 1-3 nodes to a better place (node 0 stays first)"
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for size in (1, 2, 3):
+            for i in range(1, n - size + 1):
+                j = i + size - 1
+                prev, first, last = path[i - 1], path[i], path[j]
+
+                # Length saved by cutting the segment out
+                removed = dist[prev][first]
+                if j + 1 < n:
+                    after = path[j + 1]
+                    removed += dist[last][after] - dist[prev][after]
+
+                # Try to insert the segment (as is or reversed) after every other node
+                best_gain, best_k, best_reversed = 1e-9, None, False
+                for k in range(n):
+                    if i - 1 <= k <= j:
+                        continue
+                    x = path[k]
+                    row = dist[x]
+                    if k + 1 < n:
+                        y = path[k + 1]
+                        straight = row[first] + dist[last][y] - row[y]
+                        reversed_ = row[last] + dist[first][y] - row[y]
+                    else:
+                        straight = row[first]
+                        reversed_ = row[last]
+                    if removed - straight > best_gain:
+                        best_gain, best_k, best_reversed = removed - straight, k, False
+                    if size > 1 and removed - reversed_ > best_gain:
+                        best_gain, best_k, best_reversed = removed - reversed_, k, True
+
+                if best_k is not None:
+                    segment = path[i:j + 1]
+                    if best_reversed:
+                        segment.reverse()
+                    if best_k < i:
+                        path[:] = path[:best_k + 1] + segment + path[best_k + 1:i] + path[j + 1:]
+                    else:
+                        path[:] = path[:i] + path[j + 1:best_k + 1] + segment + path[best_k + 1:]
+                    improved = True
+    return path
+
+
+def optimize_route_order(route, start=None):
+    """Reorder route objects to make the walk between them short.
+    start is optional (latitude, longitude) the walk has to begin from,
+    without it the route may begin at any object"""
+    if len(route) < 3 and start is None:
+        return route
+
+    try:
+        lats = [float(obj['latitude']) for obj in route]
+        lons = [float(obj['longitude']) for obj in route]
+    except (KeyError, TypeError, ValueError):
+        # Route with broken coordinates is kept as is
+        return route
+
+    if start is not None:
+        dist = distance_matrix([start[0]] + lats, [start[1]] + lons)
+    else:
+        # A virtual start point at zero distance from every object leaves the start free
+        dist = np.zeros((len(route) + 1, len(route) + 1))
+        dist[1:, 1:] = distance_matrix(lats, lons)
+
+    # Plain lists are much faster than NumPy for element access in the loops
+    dist = dist.tolist()
+
+    path = nearest_neighbour_path(dist)
+    path = two_opt(path, dist)
+    path = or_opt(path, dist)
+    path = two_opt(path, dist)
+
+    return [route[node - 1] for node in path[1:]]
+
+
+if __name__ == "__main__":
+    # Benchmark: python -m bot.route_optimizer
+    import random
+    import timeit
+
+    random.seed(1)
+    route = [{"name": str(i), "latitude": 53.85 + random.random() * 0.1,
+              "longitude": 27.45 + random.random() * 0.2} for i in range(20)]
+
+    def route_length(objects):
+        dist = distance_matrix([obj['latitude'] for obj in objects], [obj['longitude'] for obj in objects])
+        return sum(dist[i][i + 1] for i in range(len(objects) - 1))
+
+    optimized = optimize_route_order(route)
+    print(f"Route length: {route_length(route):.0f} m -> {route_length(optimized):.0f} m")
+
+    runs = 200
+    seconds = timeit.timeit(lambda: optimize_route_order(route), number=runs)
+    print(f"20 stops: {seconds / runs * 1000:.3f} ms per route")
+    seconds = timeit.timeit(lambda: optimize_route_order(route, start=(53.9045, 27.5577)), number=runs)
+    print(f"20 stops from a fixed start: {seconds / runs * 1000:.3f} ms per route")
@@ -0,0 +1,225 @@
+# bot/scheduler.py
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from bot.config import SCHEDULER_WORKERS, SCHEDULER_MAX_PENDING, SCHEDULER_STATS_INTERVAL
+
+
+class UpdateScheduler:
+    """Outer update middleware processing updates of one user one after another,
+    in the order they came, and updates of different users concurrently.
+    At most workers updates are processed at once, users get turns round robin.
+    At most max_pending updates are accepted, the rest wait in the order they
+    came until there is room. Updates without a user or chat are not scheduled"""
+
+    def __init__(self, workers=SCHEDULER_WORKERS, max_pending=SCHEDULER_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        # user or chat id -> deque of turns (futures) of accepted updates
+        self.queues = {}
+        # Users with queued updates and none being processed, in the order of turns
+        self.ready = deque()
+        # Users with an update being processed
+        self.running = set()
+        # (user id, turn) of updates not accepted yet
+        self.waiting = deque()
+        # Updates accepted, queued or being processed
+        self.pending = 0
+
+        # Metrics since the last reset_stats()
+        self.processed = 0
+        self.throttled = 0
+        self.peak_pending = 0
+        self.peak_waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        key = user.id if user else chat.id if chat else None
+        if key is None:
+            return await handler(event, data)
+
+        turn = asyncio.get_running_loop().create_future()
+        queued_at = time.perf_counter()
+        self.submit(key, turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            # Turn given just before the cancellation has to be passed on
+            if not turn.cancelled():
+                self.release(key)
+            raise
+
+        waited = time.perf_counter() - queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            return await handler(event, data)
+        finally:
+            self.release(key)
+
+    def submit(self, key, turn):
+        "Accept update of the user, or let it wait if the scheduler is full"
+        if self.waiting or self.pending >= self.max_pending:
+            self.waiting.append((key, turn))
+            self.throttled += 1
+            self.peak_waiting = max(self.peak_waiting, len(self.waiting))
+        else:
+            self.accept(key, turn)
+            self.dispatch()
+
+    def accept(self, key, turn):
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            if key not in self.running:
+                self.ready.append(key)
+        queue.append(turn)
+
+    def dispatch(self):
+        "Give turns to ready users while there are free workers"
+        while self.ready and len(self.running) < self.workers:
+            key = self.ready.popleft()
+            queue = self.queues[key]
+            turn = queue.popleft()
+            if not queue:
+                del self.queues[key]
+
+            if turn.cancelled():
+                # Update was cancelled while queued
+                self.pending -= 1
+                if queue:
+                    self.ready.appendleft(key)
+                continue
+
+            self.running.add(key)
+            turn.set_result(None)
+
+    def release(self, key):
+        "Update of the user is processed: admit waiting updates and give next turns"
+        self.running.discard(key)
+        self.pending -= 1
+        self.processed += 1
+        # The user goes to the end of the line with its next update
+        if key in self.queues:
+            self.ready.append(key)
+
+        while self.waiting and self.pending < self.max_pending:
+            waiting_key, turn = self.waiting.popleft()
+            if not turn.cancelled():
+                self.accept(waiting_key, turn)
+        self.dispatch()
+
+    def stats(self):
+        "Current queue depth and metrics since the last reset"
+        return {
+            'pending': self.pending,
+            'processing': len(self.running),
+            'waiting': len(self.waiting),
+            'users_queued': len(self.queues),
+            'deepest_user_queue': max(map(len, self.queues.values()), default=0),
+            'processed': self.processed,
+            'throttled': self.throttled,
+            'peak_pending': self.peak_pending,
+            'peak_waiting': self.peak_waiting,
+            'avg_wait_ms': self.wait_total / self.processed * 1000 if self.processed else 0.0,
+            'max_wait_ms': self.wait_max * 1000,
+        }
+
+    def reset_stats(self):
+        self.processed = self.throttled = 0
+        self.peak_pending = self.pending
+        self.peak_waiting = len(self.waiting)
+        self.wait_total = self.wait_max = 0.0
+
+    async def log_stats(self, interval=SCHEDULER_STATS_INTERVAL):
+        "Log metrics every interval seconds while there are updates"
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.stats()
+            if stats['processed'] or stats['pending']:
+                logging.info("Scheduler: %s", ", ".join(
+                    f"{name} {value:.1f}" if isinstance(value, float) else f"{name} {value}"
+                    for name, value in stats.items()))
+            self.reset_stats()
+
+
+async def simulate(users, updates_per_user, workers, max_pending, delay):
+    """Feed updates of users with random processing times through the scheduler.
+    Returns (problems, elapsed seconds, highest concurrency, stats)"""
+    scheduler = UpdateScheduler(workers, max_pending)
+    rng = random.Random(1)
+    seen = {user_id: [] for user_id in range(users)}
+    active_users = set()
+    concurrency = 0
+    problems = []
+
+    class User:
+        def __init__(self, user_id):
+            self.id = user_id
+
+    async def handler(event, data):
+        nonlocal concurrency
+        user_id, number = event
+        if user_id in active_users:
+            problems.append(f"user {user_id}: two updates at once")
+        active_users.add(user_id)
+        concurrency = max(concurrency, len(active_users))
+        await asyncio.sleep(rng.random() * 2 * delay)
+        seen[user_id].append(number)
+        active_users.discard(user_id)
+
+    # Updates come in random user order, every user in its own order
+    events = [(user_id, number) for number in range(updates_per_user) for user_id in range(users)]
+    rng.shuffle(events)
+    counters = dict.fromkeys(range(users), 0)
+    ordered = []
+    for user_id, _ in events:
+        ordered.append((user_id, counters[user_id]))
+        counters[user_id] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(scheduler(handler, event, {'event_from_user': User(event[0])})
+                           for event in ordered))
+    elapsed = time.perf_counter() - started
+
+    for user_id, numbers in seen.items():
+        if numbers != list(range(updates_per_user)):
+            problems.append(f"user {user_id}: updates processed in order {numbers}")
+    if concurrency > workers:
+        problems.append(f"{concurrency} updates processed at once, limit {workers}")
+    if scheduler.pending or scheduler.queues or scheduler.ready or scheduler.running or scheduler.waiting:
+        problems.append("scheduler is not empty after all updates")
+    return problems, elapsed, concurrency, scheduler.stats()
+
+
+if __name__ == "__main__":
+    # Ordering and throughput check: python -m bot.scheduler
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check per-user ordering of the update scheduler")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=20, help="updates per user")
+    parser.add_argument("--workers", type=int, default=SCHEDULER_WORKERS)
+    parser.add_argument("--max-pending", type=int, default=SCHEDULER_MAX_PENDING)
+    parser.add_argument("--delay", type=float, default=0.005, help="average processing time (in seconds)")
+    args = parser.parse_args()
+
+    problems, elapsed, concurrency, stats = asyncio.run(
+        simulate(args.users, args.updates, args.workers, args.max_pending, args.delay))
+    total = args.users * args.updates
+    print(f"{total} updates of {args.users} users in {elapsed:.2f} s ({total / elapsed:.0f}/s), "
+          f"up to {concurrency} at once; serial processing would take {total * args.delay:.1f} s")
+    print(", ".join(f"{name} {value:.1f}" if isinstance(value, float) else f"{name} {value}"
+                    for name, value in stats.items()))
+    for problem in problems[:10]:
+        print(f"FAIL: {problem}")
+    print("OK: per-user order kept" if not problems else f"{len(problems)} problems found")
+    raise SystemExit(0 if not problems else 1)
@@ -0,0 +1,232 @@
+# bot/webhook_loadtest.py
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from bot import database
+
+# Menu buttons sent by synthetic users. They only read data and never ask DeepSeek
+SYNTHETIC_TEXTS = ["👤 Мой профиль", "📊 Мои баллы", "🏪 Магазин", "🛒 Все товары", "📦 Мои покупки", "🏆 Рейтинг"]
+
+# Token of the bot started by --spawn (any token of the right format)
+LOADTEST_TOKEN = "123456:LOADTEST"
+
+
+def load_updates(path):
+    """Read recorded updates: a JSON list, a getUpdates response or one update per line"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    if isinstance(data, dict):
+        return data.get('result', [data])
+    return data
+
+
+def synthetic_updates(users, count, seed=1):
+    "Generate menu taps and location messages of registered users"
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        tg_id = rng.randint(1, users)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": tg_id, "type": "private", "first_name": f"user{tg_id}"},
+            "from": {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}"},
+        }
+        if rng.random() < 0.2:
+            message["location"] = {"latitude": 53.85 + rng.random() * 0.1, "longitude": 27.45 + rng.random() * 0.2}
+        else:
+            message["text"] = rng.choice(SYNTHETIC_TEXTS)
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+def seed_database(path, users):
+    "Register synthetic users with some points and add shop items"
+    # The connection of a previous run still points at its database
+    database.close_connection()
+    database.DATABASE_PATH = path
+    database.init_database()
+    for tg_id in range(1, users + 1):
+        database.save_user(tg_id, f"user{tg_id}", f"+37529{tg_id:07d}")
+        database.update_user_interests(tg_id, random.choice(["музеи, парки", "архитектура", "кафе, театры"]))
+        database.add_points(tg_id, random.randint(0, 50) * 10)
+    database.add_shop_item("Магнит", "Магнит с видом Минска", 50, "Сувениры")
+    database.add_shop_item("Футболка", "Футболка с логотипом", 300, "Одежда", stock=100)
+    database.close_connection()
+
+
+def fake_api_app(stats):
+    "Minimal Telegram Bot API answering every method with success, counts calls in stats"
+    app = web.Application()
+
+    async def handle(request):
+        stats['calls'] += 1
+        method = request.match_info['method'].lower()
+        if method == 'getme':
+            result = {"id": 123456, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        elif method.startswith(('send', 'edit')):
+            form = await request.post()
+            result = {"message_id": 1, "date": int(time.time()),
+                      "chat": {"id": int(form.get('chat_id', 0)), "type": "private"}, "text": form.get('text', '')}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app.router.add_post('/bot{token}/{method}', handle)
+    return app
+
+
+async def replay(url, secret, updates, concurrency):
+    """Post updates to the webhook with up to concurrency requests at once.
+    Returns (request latencies in seconds, failed requests, total time)"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    latencies = []
+    failed = 0
+
+    async def worker(session):
+        nonlocal failed
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        failed += 1
+            except aiohttp.ClientError:
+                failed += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return latencies, failed, time.perf_counter() - started
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def report(latencies, failed, elapsed):
+    latencies = sorted(latencies)
+    print(f"{len(latencies)} updates in {elapsed:.2f} s: {len(latencies) / elapsed:.0f} updates/s, {failed} failed")
+    print("latency ms: " + ", ".join(f"{name} {percentile(latencies, fraction) * 1000:.1f}"
+                                    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))))
+
+
+def wait_for_port(port, timeout=60):
+    "Wait until something listens on the local port"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listens on port {port}")
+
+
+async def run_spawned(args, updates, workers=0):
+    """Start the bot in webhook mode on a temporary database, talking to a fake
+    Bot API, replay updates against it and stop it. With workers the bot is
+    started by bot.cluster as that many processes"""
+    stats = {'calls': 0}
+    api_runner = web.AppRunner(fake_api_app(stats))
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", args.api_port).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'loadtest.db')
+        seed_database(path, args.users)
+
+        env = dict(os.environ, BOT_MODE='webhook', WEBHOOK_URL='', WEBHOOK_HOST='127.0.0.1',
+                   WEBHOOK_PORT=str(args.port), WEBHOOK_PATH=args.path, WEBHOOK_SECRET=args.secret,
+                   WEBHOOK_IN_BACKGROUND='1' if args.background else '0',
+                   TELEGRAM_BOT_TOKEN=LOADTEST_TOKEN, TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+                   DATABASE_PATH=path, WORKERS=str(workers), WORKER_BASE_PORT=str(args.port + 10))
+        bot = subprocess.Popen([sys.executable, "-m", "bot.cluster" if workers else "bot.main"], env=env)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_port, args.port)
+            url = f"http://127.0.0.1:{args.port}{args.path}"
+            result = await replay(url, args.secret, updates, args.concurrency)
+        finally:
+            stopping = time.perf_counter()
+            bot.terminate()
+            await asyncio.get_running_loop().run_in_executor(None, bot.wait)
+            print(f"bot stopped in {time.perf_counter() - stopping:.2f} s with exit code {bot.returncode}")
+
+    print(f"Bot API calls: {stats['calls']}")
+    await api_runner.cleanup()
+    return result
+
+
+def run_scaling(args, updates, counts):
+    "Run the spawned bot with each number of workers and compare throughput"
+    rates = []
+    for workers in counts:
+        print(f"--- {workers} workers")
+        latencies, failed, elapsed = asyncio.run(run_spawned(args, updates, workers))
+        report(latencies, failed, elapsed)
+        rates.append(len(latencies) / elapsed)
+
+    print(f"\nworkers  updates/s  speedup  ({os.cpu_count()} CPUs)")
+    for workers, rate in zip(counts, rates):
+        print(f"{workers:>7}  {rate:>9.0f}  {rate / rates[0]:>7.2f}")
+
+
+if __name__ == "__main__":
+    # Load test of the webhook: python -m bot.webhook_loadtest --spawn
+    parser = argparse.ArgumentParser(description="Replay Telegram updates against a webhook endpoint")
+    parser.add_argument("updates", nargs="?", help="recorded updates (JSON list, getUpdates response or JSON lines), "
+                                                   "synthetic updates when omitted")
+    parser.add_argument("--url", help="webhook URL of a running bot")
+    parser.add_argument("--secret", default=os.getenv('WEBHOOK_SECRET', ''), help="webhook secret token")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start the bot on a temporary database with a fake Bot API and test it")
+    parser.add_argument("--background", action="store_true",
+                        help="with --spawn, let the bot answer before processing (latency is then only the answer)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="with --spawn, start the bot as this many processes (python -m bot.cluster)")
+    parser.add_argument("--scaling", help="with --spawn, compare comma separated numbers of workers, e.g. 1,2,4")
+    parser.add_argument("--port", type=int, default=8090, help="webhook port of the spawned bot")
+    parser.add_argument("--api-port", type=int, default=8091, help="port of the fake Bot API")
+    parser.add_argument("--path", default="/webhook")
+    parser.add_argument("--users", type=int, default=200, help="synthetic users")
+    parser.add_argument("--count", type=int, default=5000, help="synthetic updates")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests at once")
+    args = parser.parse_args()
+
+    if not args.spawn and not args.url:
+        parser.error("either --url or --spawn is required")
+
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(args.users, args.count)
+
+    if args.spawn and args.scaling:
+        run_scaling(args, updates, [int(workers) for workers in args.scaling.split(',')])
+        raise SystemExit
+    if args.spawn:
+        results = asyncio.run(run_spawned(args, updates, args.workers))
+    else:
+        results = asyncio.run(replay(args.url, args.secret, updates, args.concurrency))
+    report(*results)
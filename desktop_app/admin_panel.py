@@ -1,17 +1,53 @@
 # desktop_app/admin_panel.py
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
+import csv
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Add parent directory to path to import database module
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from bot.database import (
-    get_all_users, get_shop_items, add_shop_item,
-    update_shop_item, delete_shop_item
+    get_users_page, count_users, iter_all_users, search_shop_items, get_shop_item, add_shop_item,
+    update_shop_item, delete_shop_item, call_db
 )
 
+# Users shown on one page of the users tab
+USERS_PAGE_SIZE = 500
+
+# Rows inserted into the users table per UI update, so the window stays responsive
+USERS_INSERT_BATCH = 100
+
+# Search runs when typing pauses for this many milliseconds
+SEARCH_DELAY = 300
+
+# Users table columns that can be sorted by (name and phone are encrypted)
+USERS_SORT_COLUMNS = {"ID": "id", "Telegram ID": "tg_id", "Баллы": "points"}
+
+
+def fetch_users_page(after, sort, descending, search):
+    "Load a page of users with decrypted name and phone (runs on the loader thread)"
+    users = get_users_page(after, sort, descending, search, USERS_PAGE_SIZE)
+    rows = [(user.id, user.tg_id, user.name, user.phone, user.points, user.interests) for user in users]
+    next_key = (getattr(users[-1], sort), users[-1].id) if users else None
+    return rows, next_key
+
+
+def export_users_csv(path):
+    """Write all users with decrypted name and phone to a CSV file (runs on the
+    loader thread, decryption is spread over several processes). Returns number of users"""
+    count = 0
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(["ID", "Telegram ID", "Имя", "Телефон", "Баллы", "Интересы"])
+        for users in iter_all_users():
+            writer.writerows((user.id, user.tg_id, user.name, user.phone, user.points, user.interests)
+                             for user in users)
+            count += len(users)
+    return count
+
 
 class AdminPanel:
     def __init__(self, root):
@@ -30,6 +66,21 @@ class AdminPanel:
         self.notebook.add(self.users_tab, text="Пользователи")
         self.notebook.add(self.shop_tab, text="Магазин")
 
+        # Users are loaded page by page on a separate thread, results are picked
+        # up by the Tk main loop with after()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="admin-loader")
+        self.users_generation = 0
+        self.users_sort = "id"
+        self.users_descending = False
+        self.users_search = ""
+        self.users_page_keys = [None]
+        self.users_next_key = None
+        self.users_total = None
+        self.users_count_generation = 0
+        self.users_page_rows = None
+        self.shop_generation = 0
+        self.pending_searches = {}
+
         # Initialize tabs
         self.setup_users_tab()
         self.setup_shop_tab()
@@ -39,6 +90,18 @@ class AdminPanel:
         self.load_shop_items()
 
     def setup_users_tab(self):
+        # Search frame
+        search_frame = ttk.Frame(self.users_tab)
+        search_frame.pack(fill=tk.X, pady=(0, 5))
+
+        ttk.Label(search_frame, text="Поиск (интересы, Telegram ID, телефон):").pack(side=tk.LEFT)
+        self.users_search_var = tk.StringVar()
+        self.users_search_var.trace_add("write", lambda *args: self.schedule_search("users", self.search_users))
+        self.users_search_entry = ttk.Entry(search_frame, width=40, textvariable=self.users_search_var)
+        self.users_search_entry.pack(side=tk.LEFT, padx=5)
+        self.users_search_entry.bind("<Return>", lambda event: self.search_users())
+        ttk.Button(search_frame, text="Найти", command=self.search_users).pack(side=tk.LEFT)
+
         # Users frame
         users_frame = ttk.Frame(self.users_tab)
         users_frame.pack(fill=tk.BOTH, expand=True)
@@ -48,7 +111,10 @@ class AdminPanel:
         self.users_tree = ttk.Treeview(users_frame, columns=columns, show="headings")
 
         for col in columns:
-            self.users_tree.heading(col, text=col)
+            if col in USERS_SORT_COLUMNS:
+                self.users_tree.heading(col, text=col, command=lambda col=col: self.sort_users(col))
+            else:
+                self.users_tree.heading(col, text=col)
             self.users_tree.column(col, width=120)
 
         # Scrollbars
@@ -61,11 +127,38 @@ class AdminPanel:
         v_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         h_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
 
+        # Page navigation
+        pages_frame = ttk.Frame(self.users_tab)
+        pages_frame.pack(fill=tk.X, pady=10)
+
+        self.prev_page_btn = ttk.Button(pages_frame, text="◀ Назад", command=self.prev_users_page,
+                                        state=tk.DISABLED)
+        self.prev_page_btn.pack(side=tk.LEFT)
+
+        self.next_page_btn = ttk.Button(pages_frame, text="Вперёд ▶", command=self.next_users_page,
+                                        state=tk.DISABLED)
+        self.next_page_btn.pack(side=tk.LEFT, padx=5)
+
+        self.users_status = ttk.Label(pages_frame, text="")
+        self.users_status.pack(side=tk.LEFT, padx=10)
+
         # Refresh button
-        refresh_btn = ttk.Button(self.users_tab, text="Обновить", command=self.load_users)
-        refresh_btn.pack(pady=10)
+        refresh_btn = ttk.Button(pages_frame, text="Обновить", command=self.load_users)
+        refresh_btn.pack(side=tk.RIGHT)
+
+        self.export_btn = ttk.Button(pages_frame, text="Экспорт CSV", command=self.export_users)
+        self.export_btn.pack(side=tk.RIGHT, padx=5)
 
     def setup_shop_tab(self):
+        # Search frame
+        search_frame = ttk.Frame(self.shop_tab)
+        search_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+
+        ttk.Label(search_frame, text="Поиск (название, описание, категория):").pack(side=tk.LEFT)
+        self.shop_search_var = tk.StringVar()
+        self.shop_search_var.trace_add("write", lambda *args: self.schedule_search("shop", self.load_shop_items))
+        ttk.Entry(search_frame, width=40, textvariable=self.shop_search_var).pack(side=tk.LEFT, padx=5)
+
         # Shop frame
         shop_frame = ttk.Frame(self.shop_tab)
         shop_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -74,7 +167,7 @@ class AdminPanel:
         items_frame = ttk.LabelFrame(shop_frame, text="Товары")
         items_frame.pack(fill=tk.BOTH, expand=True, side=tk.LEFT, padx=(0, 10))
 
-        columns = ("ID", "Название", "Цена", "Категория", "Активен")
+        columns = ("ID", "Название", "Цена", "Категория", "Остаток", "Активен")
         self.shop_tree = ttk.Treeview(items_frame, columns=columns, show="headings")
 
         for col in columns:
@@ -109,6 +202,10 @@ class AdminPanel:
         self.image_entry = ttk.Entry(details_frame, width=30)
         self.image_entry.pack(fill=tk.X, pady=(0, 5))
 
+        ttk.Label(details_frame, text="Остаток (пусто - без ограничений):").pack(anchor=tk.W, pady=(5, 0))
+        self.stock_entry = ttk.Entry(details_frame, width=30)
+        self.stock_entry.pack(fill=tk.X, pady=(0, 5))
+
         self.active_var = tk.BooleanVar()
         self.active_check = ttk.Checkbutton(details_frame, text="Активен", variable=self.active_var)
         self.active_check.pack(anchor=tk.W, pady=(5, 10))
@@ -134,27 +231,185 @@ class AdminPanel:
         refresh_btn.pack(pady=10)
 
     def load_users(self):
-        # Clear existing items
-        for item in self.users_tree.get_children():
-            self.users_tree.delete(item)
-
-        # Load users
-        users = get_all_users()
-        for user in users:
-            self.users_tree.insert("", tk.END, values=(
-                user[0], user[1], user[2], user[3], user[4], user[5]
-            ))
+        # Start again from the first page, total is counted in the background
+        self.users_page_keys = [None]
+        self.users_total = None
+        self.users_count_generation += 1
+        self.show_users_page()
+
+        future = self.loader.submit(count_users, self.users_search)
+        self.root.after(50, self.check_users_count, future, self.users_count_generation)
+
+    def schedule_search(self, key, callback):
+        # Search only once typing pauses instead of on every key press
+        pending = self.pending_searches.pop(key, None)
+        if pending:
+            self.root.after_cancel(pending)
+        self.pending_searches[key] = self.root.after(SEARCH_DELAY, self.run_search, key, callback)
+
+    def run_search(self, key, callback):
+        self.pending_searches.pop(key, None)
+        callback()
+
+    def search_users(self):
+        pending = self.pending_searches.pop("users", None)
+        if pending:
+            self.root.after_cancel(pending)
+
+        self.users_search = self.users_search_var.get().strip()
+        self.load_users()
+
+    def sort_users(self, col):
+        sort = USERS_SORT_COLUMNS[col]
+        if self.users_sort == sort:
+            self.users_descending = not self.users_descending
+        else:
+            self.users_sort = sort
+            self.users_descending = False
+
+        for heading, column in USERS_SORT_COLUMNS.items():
+            arrow = (" ▼" if self.users_descending else " ▲") if column == sort else ""
+            self.users_tree.heading(heading, text=heading + arrow)
+
+        self.load_users()
+
+    def next_users_page(self):
+        if self.users_next_key is not None:
+            self.users_page_keys.append(self.users_next_key)
+            self.show_users_page()
+
+    def prev_users_page(self):
+        if len(self.users_page_keys) > 1:
+            self.users_page_keys.pop()
+            self.show_users_page()
+
+    def show_users_page(self):
+        # Results of requests made before this one are ignored
+        self.users_generation += 1
+        generation = self.users_generation
+
+        self.users_page_rows = None
+        self.users_tree.delete(*self.users_tree.get_children())
+        self.prev_page_btn.config(state=tk.DISABLED)
+        self.next_page_btn.config(state=tk.DISABLED)
+        self.users_status.config(text="Загрузка...")
+
+        future = self.loader.submit(fetch_users_page, self.users_page_keys[-1], self.users_sort,
+                                    self.users_descending, self.users_search)
+        self.root.after(20, self.check_users_page, future, generation)
+
+    def check_users_page(self, future, generation):
+        if generation != self.users_generation:
+            return
+        if not future.done():
+            self.root.after(20, self.check_users_page, future, generation)
+            return
+
+        try:
+            rows, next_key = future.result()
+        except Exception as e:
+            self.users_status.config(text="")
+            messagebox.showerror("Ошибка", f"Не удалось загрузить пользователей: {str(e)}")
+            return
+
+        # A full page means there may be more users after it
+        self.users_next_key = next_key if len(rows) == USERS_PAGE_SIZE else None
+        self.insert_users_rows(rows, 0, generation)
+
+    def insert_users_rows(self, rows, start, generation):
+        if generation != self.users_generation:
+            return
+
+        # Insert rows in small batches, letting Tk handle events in between
+        for values in rows[start:start + USERS_INSERT_BATCH]:
+            self.users_tree.insert("", tk.END, values=values)
+
+        if start + USERS_INSERT_BATCH < len(rows):
+            self.root.after(1, self.insert_users_rows, rows, start + USERS_INSERT_BATCH, generation)
+            return
+
+        self.users_page_rows = len(rows)
+        self.prev_page_btn.config(state=tk.NORMAL if len(self.users_page_keys) > 1 else tk.DISABLED)
+        self.next_page_btn.config(state=tk.NORMAL if self.users_next_key is not None else tk.DISABLED)
+        self.update_users_status()
+
+    def check_users_count(self, future, generation):
+        # Count of an older search is not shown
+        if generation != self.users_count_generation:
+            return
+        if not future.done():
+            self.root.after(50, self.check_users_count, future, generation)
+            return
+
+        try:
+            self.users_total = future.result()
+        except Exception:
+            # The total is only informational, pages still work without it
+            self.users_total = None
+        self.update_users_status()
+
+    def update_users_status(self):
+        # Page is still loading
+        if self.users_page_rows is None:
+            return
+
+        if not self.users_page_rows:
+            self.users_status.config(text="Пользователи не найдены")
+            return
+
+        first = (len(self.users_page_keys) - 1) * USERS_PAGE_SIZE + 1
+        last = first + self.users_page_rows - 1
+        total = "..." if self.users_total is None else self.users_total
+        self.users_status.config(text=f"Страница {len(self.users_page_keys)}: пользователи {first}-{last} из {total}")
+
+    def export_users(self):
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", "*.csv")],
+                                            initialfile="users.csv")
+        if not path:
+            return
+
+        self.export_btn.config(state=tk.DISABLED, text="Экспорт...")
+        future = self.loader.submit(export_users_csv, path)
+        self.root.after(100, self.check_users_export, future, path)
+
+    def check_users_export(self, future, path):
+        if not future.done():
+            self.root.after(100, self.check_users_export, future, path)
+            return
+
+        self.export_btn.config(state=tk.NORMAL, text="Экспорт CSV")
+        try:
+            count = future.result()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось выгрузить пользователей: {str(e)}")
+            return
+        messagebox.showinfo("Успех", f"Выгружено пользователей: {count}\n{path}")
 
     def load_shop_items(self):
+        # Load shop items matching the search on the loader thread
+        self.shop_generation += 1
+        future = self.loader.submit(search_shop_items, self.shop_search_var.get())
+        self.root.after(20, self.check_shop_items, future, self.shop_generation)
+
+    def check_shop_items(self, future, generation):
+        if generation != self.shop_generation:
+            return
+        if not future.done():
+            self.root.after(20, self.check_shop_items, future, generation)
+            return
+
+        try:
+            items = future.result()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось загрузить товары: {str(e)}")
+            return
+
         # Clear existing items
-        for item in self.shop_tree.get_children():
-            self.shop_tree.delete(item)
+        self.shop_tree.delete(*self.shop_tree.get_children())
 
-        # Load shop items
-        items = get_shop_items(active_only=False)
         for item in items:
             self.shop_tree.insert("", tk.END, values=(
-                item[0], item[1], item[3], item[4], "Да" if item[6] else "Нет"
+                item[0], item[1], item[3], item[4], "" if item[7] is None else item[7], "Да" if item[6] else "Нет"
             ))
 
     def on_shop_select(self, event):
@@ -168,26 +423,27 @@ class AdminPanel:
             self.delete_btn.config(state=tk.NORMAL)
 
             # Load item data
-            items = get_shop_items(active_only=False)
-            for shop_item in items:
-                if shop_item[0] == values[0]:
-                    self.name_entry.delete(0, tk.END)
-                    self.name_entry.insert(0, shop_item[1])
+            shop_item = get_shop_item(values[0])
+            if shop_item:
+                self.name_entry.delete(0, tk.END)
+                self.name_entry.insert(0, shop_item[1])
+
+                self.desc_text.delete(1.0, tk.END)
+                self.desc_text.insert(1.0, shop_item[2] or "")
 
-                    self.desc_text.delete(1.0, tk.END)
-                    self.desc_text.insert(1.0, shop_item[2] or "")
+                self.price_entry.delete(0, tk.END)
+                self.price_entry.insert(0, str(shop_item[3]))
 
-                    self.price_entry.delete(0, tk.END)
-                    self.price_entry.insert(0, str(shop_item[3]))
+                self.category_entry.delete(0, tk.END)
+                self.category_entry.insert(0, shop_item[4] or "")
 
-                    self.category_entry.delete(0, tk.END)
-                    self.category_entry.insert(0, shop_item[4] or "")
+                self.image_entry.delete(0, tk.END)
+                self.image_entry.insert(0, shop_item[5] or "")
 
-                    self.image_entry.delete(0, tk.END)
-                    self.image_entry.insert(0, shop_item[5] or "")
+                self.stock_entry.delete(0, tk.END)
+                self.stock_entry.insert(0, "" if shop_item[7] is None else str(shop_item[7]))
 
-                    self.active_var.set(bool(shop_item[6]))
-                    break
+                self.active_var.set(bool(shop_item[6]))
 
     def add_shop_item(self):
         try:
@@ -196,18 +452,19 @@ class AdminPanel:
             price = int(self.price_entry.get())
             category = self.category_entry.get()
             image_url = self.image_entry.get() or None
+            stock = int(self.stock_entry.get()) if self.stock_entry.get().strip() else None
             is_active = self.active_var.get()
 
             if not name or not price:
                 messagebox.showerror("Ошибка", "Заполните обязательные поля (название и цена)")
                 return
 
-            add_shop_item(name, description, price, category, image_url)
+            call_db(add_shop_item, name, description, price, category, image_url, stock)
             messagebox.showinfo("Успех", "Товар добавлен")
             self.load_shop_items()
             self.clear_form()
         except ValueError:
-            messagebox.showerror("Ошибка", "Цена должна быть числом")
+            messagebox.showerror("Ошибка", "Цена и остаток должны быть числами")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось добавить товар: {str(e)}")
 
@@ -225,17 +482,18 @@ class AdminPanel:
             price = int(self.price_entry.get())
             category = self.category_entry.get()
             image_url = self.image_entry.get() or None
+            stock = int(self.stock_entry.get()) if self.stock_entry.get().strip() else None
             is_active = self.active_var.get()
 
             if not name or not price:
                 messagebox.showerror("Ошибка", "Заполните обязательные поля (название и цена)")
                 return
 
-            update_shop_item(item_id, name, description, price, category, image_url, is_active)
+            call_db(update_shop_item, item_id, name, description, price, category, image_url, is_active, stock)
             messagebox.showinfo("Успех", "Товар обновлен")
             self.load_shop_items()
         except ValueError:
-            messagebox.showerror("Ошибка", "Цена должна быть числом")
+            messagebox.showerror("Ошибка", "Цена и остаток должны быть числами")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось обновить товар: {str(e)}")
 
@@ -249,7 +507,7 @@ class AdminPanel:
                 item = self.shop_tree.item(selection[0])
                 item_id = item['values'][0]
 
-                delete_shop_item(item_id)
+                call_db(delete_shop_item, item_id)
                 messagebox.showinfo("Успех", "Товар удален")
                 self.load_shop_items()
                 self.clear_form()
@@ -262,6 +520,7 @@ class AdminPanel:
         self.price_entry.delete(0, tk.END)
         self.category_entry.delete(0, tk.END)
         self.image_entry.delete(0, tk.END)
+        self.stock_entry.delete(0, tk.END)
         self.active_var.set(True)
 
         self.update_btn.config(state=tk.DISABLED)